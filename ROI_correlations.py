@@ -1,60 +1,64 @@
 #!/usr/bin/env python3
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import statsmodels.api as sm
-from scipy import stats
+from batched_regression import batched_ols
+from render_service import render_all
+from excel_cache import read_excel
 
-def main(input_excel, output_prefix="results"):
+def main(input_excel, output_prefix="results", pdf_path=None, n_workers=4):
     # Load Excel
-    df = pd.read_excel(input_excel)
+    df = read_excel(input_excel)
     df = df.drop(df.columns[[0, 1]], axis=1)
     df = df.dropna()
     # === 1. Correlation Heatmap ===
     corr = df.corr() ** 2
 
-    plt.figure(figsize=(10, 8))
-    sns.heatmap(corr, annot=True, fmt=".2f", cmap="coolwarm", square=True, cbar=True)
-    plt.title("R² Heatmap")
-    plt.tight_layout()
-    plt.savefig(f"{output_prefix}_heatmap.png", dpi=300)
-    plt.close()
+    specs = [{
+        "kind": "heatmap",
+        "path": f"{output_prefix}_heatmap.png",
+        "figsize": (10, 8),
+        "matrix": corr.to_numpy(),
+        "labels": corr.columns.tolist(),
+        "annot": True,
+        "title": "R² Heatmap",
+    }]
 
     # === 2. Regression plots (first 7 variables vs cluster) ===
     predictors = [col for col in df.columns if not col.startswith(("cluster", "age"))]
     target = "cluster"
 
+    # Fit every predictor against the target in one pass
+    fits = batched_ols(df[predictors], df[target])
+
     for col in predictors:
         x = df[col]
         y = df[target]
-
-        # Fit linear regression with statsmodels
-        X = sm.add_constant(x)  # add intercept
-        model = sm.OLS(y, X).fit()
-
-        r2 = model.rsquared
-        pval = model.pvalues[1]  # p-value for slope
+        r2 = fits.loc[col, "r2"]
+        pval = fits.loc[col, "pvalue"]  # p-value for slope
 
         # Scatter + regression line
-        plt.figure(figsize=(6, 5))
-        sns.regplot(x=x, y=y, ci=95, line_kws={"color": "red"})
-        plt.xlabel(f"{col} (SUVR)" if col in ["hn", "ihn"] else f"{col} (SUV)")
-        plt.ylabel(f"{target} (SUV)")
-        plt.title(f"{col} vs {target}, R² = {r2:.3f}")
-        plt.tight_layout()
-        plt.savefig(f"{output_prefix}_{col}_vs_{target}.png", dpi=300)
-        plt.close()
+        specs.append({
+            "kind": "regplot",
+            "path": f"{output_prefix}_{col}_vs_{target}.png",
+            "figsize": (6, 5),
+            "x": x.to_numpy(),
+            "y": y.to_numpy(),
+            "xlabel": f"{col} (SUVR)" if col in ["hn", "ihn"] else f"{col} (SUV)",
+            "ylabel": f"{target} (SUV)",
+            "title": f"{col} vs {target}, R² = {r2:.3f}",
+        })
 
+    # PNGs, or one page each in pdf_path
+    render_all(specs, pdf_path=pdf_path, n_workers=n_workers)
     print("✅ Done. Heatmap and regression plots saved.")
 
 if __name__ == "__main__":
     # Example usage
-    # python analysis.py table.xlsx results
+    # python analysis.py table.xlsx results [--pdf]
     import sys
-    if len(sys.argv) < 2:
-        print("Usage: python analysis.py <input_excel> [output_prefix]")
+    args = [a for a in sys.argv[1:] if a != "--pdf"]
+    if len(args) < 1:
+        print("Usage: python analysis.py <input_excel> [output_prefix] [--pdf]")
         sys.exit(1)
 
-    input_excel = sys.argv[1]
-    output_prefix = sys.argv[2] if len(sys.argv) > 2 else "results"
-    main(input_excel, output_prefix)
+    input_excel = args[0]
+    output_prefix = args[1] if len(args) > 1 else "results"
+    main(input_excel, output_prefix, pdf_path=f"{output_prefix}_plots.pdf" if "--pdf" in sys.argv else None)
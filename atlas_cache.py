@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import nibabel as nib
+import numpy as np
+
+# Compiled atlases live here, one sub-folder per (content hash, mode), evicted least-recently-used first
+CACHE_DIR = os.environ.get("ATLAS_CACHE_DIR", ".atlas_cache")
+MAX_BYTES = int(os.environ.get("ATLAS_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+# Entries used more recently than this (seconds) are never evicted, so concurrent readers keep them
+EVICT_MIN_AGE = 60
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """SHA-256 of a file's content."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def memo_file_hash(path, index_dir):
+    """file_hash memoised per (path, size, mtime) in index_dir, so unchanged files are hashed once."""
+    st = os.stat(path)
+    stamp = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+    stamp_file = os.path.join(index_dir, hashlib.sha1(stamp.encode()).hexdigest())
+    if os.path.exists(stamp_file):
+        with open(stamp_file, "r") as f:
+            return f.read().strip()
+    key = file_hash(path)
+    os.makedirs(index_dir, exist_ok=True)
+    tmp = f"{stamp_file}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "w") as f:
+        f.write(key)
+    os.replace(tmp, stamp_file)
+    return key
+
+
+def touch_entry(entry):
+    """Mark a cache entry as just used; False if it is missing (never written or evicted)."""
+    try:
+        os.utime(entry)
+    except FileNotFoundError:
+        return False
+    return os.path.exists(os.path.join(entry, "meta.json"))
+
+
+def evict_entries(cache_dir, max_bytes, keep=None, min_age=EVICT_MIN_AGE):
+    """Delete least-recently-used entry folders (except keep) until cache_dir fits in max_bytes.
+
+    Entries are the non-hidden sub-folders other than index/; readers mark
+    them as used with touch_entry before loading, and entries used in the
+    last min_age seconds are never deleted, so a reader is not left with a
+    folder removed between lookup and load.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir() and not entry.name.startswith(".") and entry.name != "index":
+            size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+            entries.append((entry.stat().st_mtime, size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    cutoff = time.time() - min_age
+    for mtime, size, path in sorted(entries):
+        if total <= max_bytes or mtime > cutoff:
+            break
+        if path == keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+class AtlasIndex:
+    """Per-label flat voxel indices of an atlas in CSR layout.
+
+    indices holds Fortran-order (NIfTI on-disk order) flat offsets grouped by
+    label; the voxels of labels[i] are indices[indptr[i]:indptr[i + 1]].
+    """
+
+    def __init__(self, labels, indptr, indices, shape, affine, key=None):
+        self.labels = labels
+        self.indptr = indptr
+        self.indices = indices
+        self.shape = tuple(shape)
+        self.affine = np.asarray(affine)
+        self.key = key
+
+    def voxels(self, label):
+        """Flat voxel indices of one label (empty if the label is absent)."""
+        i = np.searchsorted(self.labels, label)
+        if i == len(self.labels) or self.labels[i] != label:
+            return self.indices[:0]
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def mask_voxels(self):
+        """Flat voxel indices of every label > 0."""
+        start = self.indptr[np.searchsorted(self.labels, 1)]
+        return self.indices[start:]
+
+    def mask(self, label=None):
+        """Boolean volume of one label, or of every label > 0."""
+        out = np.zeros(self.shape, dtype=bool, order="F")
+        idx = self.mask_voxels() if label is None else self.voxels(label)
+        out.reshape(-1, order="F")[idx] = True
+        return out
+
+    def bbox(self, label=None):
+        """Tuple of slices bounding one label, or every label > 0 (None if empty)."""
+        idx = self.mask_voxels() if label is None else self.voxels(label)
+        if idx.size == 0:
+            return None
+        coords = np.unravel_index(idx, self.shape, order="F")
+        return tuple(slice(int(c.min()), int(c.max()) + 1) for c in coords)
+
+    def slab_voxels(self, label=None, box=None):
+        """(bbox, flat Fortran-order indices of the voxels within the bbox-sized slab).
+
+        box defaults to the label's own bounding box; pass an enclosing one to
+        index several labels or masks in one shared slab.
+        """
+        box = box or self.bbox(label)
+        if box is None:
+            return None, self.indices[:0]
+        idx = self.mask_voxels() if label is None else self.voxels(label)
+        coords = np.unravel_index(idx, self.shape, order="F")
+        local = [c - s.start for c, s in zip(coords, box)]
+        return box, np.ravel_multi_index(local, [s.stop - s.start for s in box], order="F")
+
+    def values(self, volume, label=None):
+        """Values of volume under one label, or under every label > 0."""
+        idx = self.mask_voxels() if label is None else self.voxels(label)
+        return flat_view(volume)[idx]
+
+
+def flat_view(volume):
+    """Fortran-order flat view of a volume (no copy for NIfTI-loaded arrays)."""
+    return np.asarray(volume).reshape(-1, order="F")
+
+
+def _cache_key(path, threshold, cache_dir):
+    # Shape and affine are part of the file content, so the content hash covers them
+    h = hashlib.sha256()
+    h.update(memo_file_hash(path, os.path.join(cache_dir, "index")).encode())
+    h.update(repr(threshold).encode())
+    return h.hexdigest()[:32]
+
+
+def compile_atlas(img, threshold=None):
+    """Build the CSR index of a loaded atlas image.
+
+    Without threshold the voxel values are truncated to integer labels, as
+    get_fdata().astype(int) does; with a threshold the image is a binary
+    mask (value > threshold) stored as label 1.
+    """
+    data = flat_view(np.asanyarray(img.dataobj))
+    if threshold is None:
+        flat_labels = np.trunc(data).astype(np.int64) if data.dtype.kind == "f" else data.astype(np.int64)
+        nz = np.flatnonzero(flat_labels)
+        values = flat_labels[nz]
+    else:
+        nz = np.flatnonzero(data > threshold)
+        values = np.ones(len(nz), dtype=np.int64)
+
+    order = np.argsort(values, kind="stable")
+    indices = nz[order]
+    labels, counts = np.unique(values, return_counts=True)
+    indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return AtlasIndex(labels, indptr, indices, img.shape[:3], img.affine)
+
+
+def load_atlas_index(path, threshold=None, cache_dir=None, max_bytes=None):
+    """Return the AtlasIndex of an atlas file, compiling it on first use.
+
+    The arrays are memory-mapped from the cache, so repeated runs and
+    concurrent workers share one on-disk copy. An unchanged file is neither
+    hashed nor opened again; the cache is kept under max_bytes
+    (ATLAS_CACHE_MAX_BYTES) by evicting least-recently-used atlases.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    key = _cache_key(path, threshold, cache_dir)
+    entry = os.path.join(cache_dir, key)
+
+    if not touch_entry(entry):
+        index = compile_atlas(nib.load(path), threshold)
+        # Write into a private folder and rename, so concurrent compilers never see partial entries
+        tmp = os.path.join(cache_dir, f".{key}.{uuid.uuid4().hex}")
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, "labels.npy"), index.labels)
+        np.save(os.path.join(tmp, "indptr.npy"), index.indptr)
+        np.save(os.path.join(tmp, "indices.npy"), index.indices)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"source": os.path.abspath(path), "threshold": threshold,
+                       "shape": list(index.shape), "affine": index.affine.tolist()}, f)
+        try:
+            os.rename(tmp, entry)
+            print(f"Compiled atlas index for {path} → {entry}")
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+        evict_entries(cache_dir, MAX_BYTES if max_bytes is None else max_bytes, keep=entry)
+
+    with open(os.path.join(entry, "meta.json"), "r") as f:
+        meta = json.load(f)
+    return AtlasIndex(
+        np.load(os.path.join(entry, "labels.npy"), mmap_mode="r"),
+        np.load(os.path.join(entry, "indptr.npy"), mmap_mode="r"),
+        np.load(os.path.join(entry, "indices.npy"), mmap_mode="r"),
+        meta["shape"], meta["affine"], key=key,
+    )
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+import os
+import glob
+import json
+import uuid
+import shutil
+import hashlib
+import argparse
+import nibabel as nib
+import numpy as np
+from scipy.io import loadmat
+from scipy.ndimage import affine_transform
+from atlas_cache import memo_file_hash, touch_entry, evict_entries, compile_atlas
+
+# Resampled atlases live here, one sub-folder per (atlas content, target grid, transform),
+# evicted least-recently-used first
+CACHE_DIR = os.environ.get("RESAMPLE_CACHE_DIR", ".resample_cache")
+MAX_BYTES = int(os.environ.get("RESAMPLE_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+PONS_LABEL = 35
+
+# ITK/ANTs transforms work in LPS world coordinates, NIfTI affines in RAS
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+
+def load_ants_affine(path, invert=False):
+    """4x4 RAS matrix of an ANTs/ITK affine, mapping points of the fixed space to the moving space.
+
+    Reads the text format (Parameters:/FixedParameters: lines) and ANTs'
+    binary .mat files. invert=True gives the inverse, as -t [path,1] does
+    in antsApplyTransforms.
+    """
+    if path.endswith(".mat"):
+        mat = loadmat(path)
+        params = next(v for k, v in mat.items() if k.startswith("AffineTransform")).ravel()
+        center = mat["fixed"].ravel() if "fixed" in mat else np.zeros(3)
+    else:
+        params, center = None, np.zeros(3)
+        with open(path, "r") as f:
+            for line in f:
+                if line.startswith("Parameters:"):
+                    params = np.array(line.split(":", 1)[1].split(), dtype=float)
+                elif line.startswith("FixedParameters:"):
+                    center = np.array(line.split(":", 1)[1].split(), dtype=float)
+    if params is None or len(params) != 12:
+        raise ValueError(f"{path} is not a 3D affine transform")
+
+    matrix, translation = params[:9].reshape(3, 3), params[9:12]
+    lps = np.eye(4)
+    lps[:3, :3] = matrix
+    lps[:3, 3] = translation + center - matrix @ center
+    ras = LPS_TO_RAS @ lps @ LPS_TO_RAS
+    return np.linalg.inv(ras) if invert else ras
+
+
+def _cache_key(atlas_path, shape, affine, transform, cache_dir):
+    h = hashlib.sha256()
+    h.update(memo_file_hash(atlas_path, os.path.join(cache_dir, "index")).encode())
+    h.update(np.asarray(shape[:3], dtype=np.int64).tobytes())
+    h.update(np.asarray(affine, dtype=np.float64).round(6).tobytes())
+    h.update(b"identity" if transform is None else np.asarray(transform, dtype=np.float64).round(6).tobytes())
+    return h.hexdigest()[:32]
+
+
+def _resample(atlas_path, target_shape, target_affine, transform):
+    img = nib.load(atlas_path)
+    data = np.asanyarray(img.dataobj)
+    if data.ndim > 3:
+        data = data[..., 0]
+    world = np.eye(4) if transform is None else np.asarray(transform, dtype=float)
+    # Target voxel → target world → atlas world → atlas voxel
+    vox = np.linalg.inv(img.affine) @ world @ np.asarray(target_affine, dtype=float)
+    return affine_transform(data, vox[:3, :3], offset=vox[:3, 3], output_shape=tuple(target_shape[:3]),
+                            order=0, mode="constant", cval=0)
+
+
+def resample_atlas(atlas_path, target_shape, target_affine, transform=None, cache_dir=None, cache=True,
+                   max_bytes=None):
+    """Nearest-neighbour resampling of an atlas onto a target grid, cached on disk.
+
+    transform maps target world coordinates to atlas world coordinates (4x4,
+    RAS); None means both grids share one world space. Subjects on identical
+    grids with the same transform share one cached result, memory-mapped;
+    the cache is kept under max_bytes (RESAMPLE_CACHE_MAX_BYTES). Pass
+    cache=False for per-subject atlases, whose results would never be reused.
+    """
+    if not cache:
+        return _resample(atlas_path, target_shape, target_affine, transform)
+
+    cache_dir = cache_dir or CACHE_DIR
+    key = _cache_key(atlas_path, target_shape, target_affine, transform, cache_dir)
+    entry = os.path.join(cache_dir, key)
+
+    if not touch_entry(entry):
+        out = _resample(atlas_path, target_shape, target_affine, transform)
+        # Write into a private folder and rename, so concurrent workers never see partial entries
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = os.path.join(cache_dir, f".{key}.{uuid.uuid4().hex}")
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, "data.npy"), np.asfortranarray(out))
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"source": os.path.abspath(atlas_path), "shape": list(target_shape[:3]),
+                       "affine": np.asarray(target_affine).tolist(),
+                       "transform": None if transform is None else np.asarray(transform).tolist()}, f)
+        try:
+            os.rename(tmp, entry)
+            print(f"Resampled {atlas_path} → {entry}")
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+        evict_entries(cache_dir, MAX_BYTES if max_bytes is None else max_bytes, keep=entry)
+
+    return np.load(os.path.join(entry, "data.npy"), mmap_mode="r")
+
+
+def native_label_mask(atlas_path, structures_path, transform=None, label=PONS_LABEL):
+    """Atlas resampled onto a native structures image and intersected with one of its labels.
+
+    The in-memory equivalent of antsApplyTransforms followed by fslmaths
+    -thr/-uthr/-bin/-mas in movepons2native.sh; returns a uint8 image.
+    """
+    structures = nib.load(structures_path)
+    resampled = resample_atlas(atlas_path, structures.shape, structures.affine, transform)
+    labels = np.asanyarray(structures.dataobj)
+    mask = (resampled > 0) & (np.trunc(labels) == label)
+    return nib.Nifti1Image(mask.astype(np.uint8), structures.affine)
+
+
+def native_label_index(atlas_path, structures_path, transform=None, label=PONS_LABEL):
+    """AtlasIndex of native_label_mask, for consumers of load_atlas_index (mask is label 1)."""
+    return compile_atlas(native_label_mask(atlas_path, structures_path, transform, label))
+
+
+def structures_transform(atlas_folder, subject_id):
+    """Inverse of matrix_affine_native_to_mni_<id>.txt (as movepons2native.sh applies it), or None."""
+    path = os.path.join(atlas_folder, f"matrix_affine_native_to_mni_{subject_id}.txt")
+    return load_ants_affine(path, invert=True) if os.path.exists(path) else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write wfu_pons_native_<id>.nii.gz for every native_structures_<id> "
+                                                 "(replaces movepons2native.sh).")
+    parser.add_argument("--atlas", default="wfu_pons.nii")
+    parser.add_argument("--folder", default="results_assembly")
+    parser.add_argument("--label", type=int, default=PONS_LABEL)
+    args = parser.parse_args()
+
+    for ref in sorted(glob.glob(os.path.join(args.folder, "native_structures_*.nii.gz"))):
+        subject_id = os.path.basename(ref)[len("native_structures_"):-len(".nii.gz")]
+        out = os.path.join(args.folder, f"wfu_pons_native_{subject_id}.nii.gz")
+        transform = structures_transform(args.folder, subject_id)
+        nib.save(native_label_mask(args.atlas, ref, transform, args.label), out)
+        print(f"Processing {subject_id} ... → {out}")
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+import sys
+import numpy as np
+import pandas as pd
+from scipy import stats
+from excel_cache import read_excel
+
+
+def batched_ols(X, y, missing="none"):
+    """Simple OLS of y on every column of X at once: slope, intercept, R², slope p-value and n.
+
+    Equivalent to fitting sm.OLS(y, sm.add_constant(X[col])) per column.
+    missing="none" gives NaN results for a column with any NaN in it or in y
+    (statsmodels' default); missing="drop" drops the NaN rows of each column
+    separately.
+    """
+    columns = list(X.columns) if isinstance(X, pd.DataFrame) else list(range(np.shape(X)[1]))
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float).reshape(-1)
+    if X.shape[0] != y.shape[0]:
+        raise ValueError(f"X has {X.shape[0]} rows, y has {y.shape[0]}")
+
+    valid = np.isfinite(X) & np.isfinite(y)[:, None]
+    n = valid.sum(axis=0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mx = np.where(valid, X, 0).sum(axis=0) / n
+        my = np.where(valid, y[:, None], 0).sum(axis=0) / n
+        xc = np.where(valid, X - mx, 0)
+        yc = np.where(valid, y[:, None] - my, 0)
+        sxx = (xc ** 2).sum(axis=0)
+        syy = (yc ** 2).sum(axis=0)
+        sxy = (xc * yc).sum(axis=0)
+
+        slope = sxy / sxx
+        intercept = my - slope * mx
+        r2 = sxy ** 2 / (sxx * syy)
+        df_resid = n - 2
+        t = np.sqrt(r2 * df_resid / (1 - r2)) * np.sign(slope)
+        pvalue = 2 * stats.t.sf(np.abs(t), df_resid)
+
+    out = pd.DataFrame({"slope": slope, "intercept": intercept, "r2": r2, "pvalue": pvalue, "n": n},
+                       index=pd.Index(columns, name="predictor"))
+    if missing == "none":
+        out.loc[~valid.all(axis=0), ["slope", "intercept", "r2", "pvalue"]] = np.nan
+        out["n"] = len(y)
+    elif missing != "drop":
+        raise ValueError(f"missing must be 'none' or 'drop', not {missing!r}")
+    return out
+
+
+if __name__ == "__main__":
+    # python batched_regression.py table.xlsx target [output.xlsx]
+    if len(sys.argv) < 3:
+        print("Usage: python batched_regression.py <input_excel> <target> [output_excel]")
+        sys.exit(1)
+
+    df = read_excel(sys.argv[1])
+    target = sys.argv[2]
+    predictors = [c for c in df.select_dtypes("number").columns if c != target]
+    table = batched_ols(df[predictors], df[target], missing="drop")
+    print(table.sort_values("r2", ascending=False))
+    if len(sys.argv) > 3:
+        table.to_excel(sys.argv[3])
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import glob
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+from synthetic_cohort import make_cohort, NATIVE_SHAPE
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STAGES = ["extract_aal", "calculate_rois", "extract_cluster_mean", "realign_center_mass", "erode_nifti"]
+
+
+def run_stage(stage, n_workers):
+    """Run one stage on the cohort in the current directory (called in a fresh child process)."""
+    if stage == "extract_aal":
+        import extract_aal
+        if n_workers > 1:
+            extract_aal.compute_averages_parallel("shoot/", "aal116.json", "aal_values.xlsx", n_workers=n_workers,
+                                                  incremental=False)
+        else:
+            extract_aal.compute_averages("shoot/", "aal116.json", "aal_values.xlsx", incremental=False)
+    elif stage == "calculate_rois":
+        import calculate_rois
+        files = calculate_rois.find_files("coreg_center_mass_reorient", "pons_r_petsuv.nii.gz")
+        calculate_rois.calculate_rois_parallel(files, "results_assembly/structures.json", "results_assembly",
+                                               "roi_values.xlsx", "coreg_center_mass_reorient", n_workers=n_workers,
+                                               qc=True, qc_workers=max(1, n_workers // 2), incremental=False)
+    elif stage == "extract_cluster_mean":
+        import extract_cluster_mean
+        extract_cluster_mean.extract_means("wr_petsuv", "shoot", store_path="results.sqlite", incremental=False)
+    elif stage == "realign_center_mass":
+        import realign_center_mass
+        realign_center_mass.realign_nii_files("realign", n_workers=n_workers)
+    elif stage == "erode_nifti":
+        import erode_nifti
+        for f in sorted(glob.glob("results_assembly/wfu_pons_native_*.nii.gz")):
+            erode_nifti.erode_nifti(f, os.path.join("eroded", os.path.basename(f)))
+    else:
+        raise ValueError(f"Unknown stage: {stage}")
+
+
+def peak_rss():
+    """Peak RSS in MB of this process and of its largest finished worker."""
+    to_mb = 1 / (1024 * 1024) if sys.platform == "darwin" else 1 / 1024  # ru_maxrss: bytes on macOS, KiB on Linux
+    self_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * to_mb
+    try:
+        # On Linux ru_maxrss survives exec and would include the benchmark parent; VmHWM is this image only
+        with open("/proc/self/status", "r") as f:
+            self_mb = next(int(line.split()[1]) for line in f if line.startswith("VmHWM:")) / 1024
+    except (OSError, StopIteration):
+        pass
+    return {"peak_rss_mb": self_mb,
+            "peak_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * to_mb}
+
+
+def _prepare(stage, cohort):
+    """Fresh per-run state: empty caches and untouched inputs, so every run starts cold."""
+    run_dir = tempfile.mkdtemp(prefix=f"bench_{stage}_", dir=cohort)
+    env = dict(os.environ, ATLAS_CACHE_DIR=os.path.join(run_dir, "atlas_cache"),
+               NII_CACHE_DIR=os.path.join(run_dir, "nii_cache"), XLSX_CACHE_DIR=os.path.join(run_dir, "xlsx_cache"),
+               PYTHONPATH=os.pathsep.join([HERE, os.environ.get("PYTHONPATH", "")]))
+    for name in ("aal116.json", "r_aal.nii", "multreg_cluster.nii", "shoot", "coreg_center_mass_reorient",
+                 "results_assembly"):
+        os.symlink(os.path.join(cohort, name), os.path.join(run_dir, name))
+    if stage == "realign_center_mass":
+        shutil.copytree(os.path.join(cohort, "coreg_center_mass_reorient"), os.path.join(run_dir, "realign"))
+    if stage == "erode_nifti":
+        os.makedirs(os.path.join(run_dir, "eroded"))
+    return run_dir, env
+
+
+def measure(stage, cohort, n_workers):
+    """Wall time and peak RSS of one stage, run in a child process."""
+    run_dir, env = _prepare(stage, cohort)
+    try:
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, os.path.join(HERE, "benchmark.py"), "_stage", stage, str(n_workers)],
+                              cwd=run_dir, env=env, capture_output=True, text=True)
+        wall = time.perf_counter() - start
+        if proc.returncode != 0:
+            raise RuntimeError(f"{stage} failed:\n{proc.stderr[-2000:]}")
+        usage = json.loads(proc.stdout.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return {"stage": stage, "workers": n_workers, "wall_s": wall, **usage}
+
+
+def git_revision():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=HERE,
+                               capture_output=True, text=True).stdout.strip()
+        return rev + ("-dirty" if dirty else "")
+    except OSError:
+        return None
+
+
+def run_benchmarks(sizes, workers, stages=STAGES, repeat=1, native_shape=NATIVE_SHAPE, output="benchmark.json",
+                   work_dir=None):
+    """Time every stage at every cohort size and worker count; results go to a JSON file."""
+    work_dir = work_dir or tempfile.mkdtemp(prefix="bench_cohorts_")
+    results = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "native_shape": list(native_shape),
+        "runs": [],
+    }
+    for n in sizes:
+        cohort = os.path.join(work_dir, f"cohort_{n}")
+        if not os.path.exists(os.path.join(cohort, "r_aal.nii")):
+            make_cohort(cohort, n, native_shape=native_shape)
+        for stage in stages:
+            # Sequential-only stages are measured once
+            for w in (workers if stage not in ("extract_cluster_mean", "erode_nifti") else [1]):
+                for r in range(repeat):
+                    run = {"n_subjects": n, "repeat": r, **measure(stage, cohort, w)}
+                    results["runs"].append(run)
+                    print(f"{stage:22s} n={n:<4d} workers={w:<3d} {run['wall_s']:8.2f} s  "
+                          f"peak RSS {run['peak_rss_mb']:8.1f} MB (workers {run['peak_child_rss_mb']:.1f} MB)")
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {output}")
+    return results
+
+
+def compare(baseline_path, candidate_path):
+    """Per (stage, size, workers) best wall time and peak RSS of two result files, with ratios."""
+    def best(path):
+        with open(path, "r") as f:
+            data = json.load(f)
+        table = {}
+        for run in data["runs"]:
+            key = (run["stage"], run["n_subjects"], run["workers"])
+            prev = table.get(key)
+            table[key] = run if prev is None or run["wall_s"] < prev["wall_s"] else prev
+        return data.get("revision"), table
+
+    rev_a, a = best(baseline_path)
+    rev_b, b = best(candidate_path)
+    print(f"baseline {rev_a}  vs  candidate {rev_b}")
+    print(f"{'stage':22s} {'n':>4s} {'w':>3s} {'base s':>9s} {'cand s':>9s} {'ratio':>6s} {'base MB':>9s} {'cand MB':>9s}")
+    for key in sorted(set(a) & set(b)):
+        ra, rb = a[key], b[key]
+        print(f"{key[0]:22s} {key[1]:4d} {key[2]:3d} {ra['wall_s']:9.2f} {rb['wall_s']:9.2f} "
+              f"{rb['wall_s'] / ra['wall_s']:6.2f} {ra['peak_rss_mb']:9.1f} {rb['peak_rss_mb']:9.1f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "_stage":
+        # Child process: run the stage, then report its own and its workers' peak RSS
+        run_stage(sys.argv[2], int(sys.argv[3]))
+        print(json.dumps(peak_rss()))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Benchmark the volume-processing stages on synthetic cohorts.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run")
+    run.add_argument("--sizes", type=int, nargs="+", default=[4, 16])
+    run.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    run.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    run.add_argument("--repeat", type=int, default=1)
+    run.add_argument("--native-shape", type=int, nargs=3, default=list(NATIVE_SHAPE))
+    run.add_argument("--work-dir", default=None, help="where cohorts are generated (kept for reuse)")
+    run.add_argument("--output", default="benchmark.json")
+    cmp_ = sub.add_parser("compare")
+    cmp_.add_argument("baseline")
+    cmp_.add_argument("candidate")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run_benchmarks(args.sizes, args.workers, args.stages, args.repeat, tuple(args.native_shape), args.output,
+                       args.work_dir)
+    else:
+        compare(args.baseline, args.candidate)
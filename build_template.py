@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+import os
+import argparse
+import nibabel as nib
+import numpy as np
+from volume_cache import load_nifti
+
+
+def find_controls(directory, name="wr_petsuv.nii"):
+    """All control scans under directory, as absolute paths."""
+    matches = []
+    for dirpath, _, filenames in os.walk(directory):
+        if name in filenames:
+            matches.append(os.path.abspath(os.path.join(dirpath, name)))
+    return sorted(matches)
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def load_volume(path):
+    # NaN voxels count as 0, like create_hn_template.m
+    return np.nan_to_num(load_nifti(path).get_fdata(), nan=0.0)
+
+
+def empty_stats(shape, affine):
+    return {"n": 0, "mean": np.zeros(shape), "m2": np.zeros(shape), "affine": affine, "members": {}}
+
+
+def add_chunk(stats, chunk):
+    """Merge a chunk of volumes (k, x, y, z) into the running mean / M2 (Chan et al.)."""
+    k = chunk.shape[0]
+    chunk_mean = chunk.mean(axis=0)
+    chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+
+    n = stats["n"]
+    total = n + k
+    delta = chunk_mean - stats["mean"]
+    stats["mean"] += delta * (k / total)
+    stats["m2"] += chunk_m2 + delta ** 2 * (n * k / total)
+    stats["n"] = total
+
+
+def remove_volume(stats, volume):
+    """Take one volume back out of the running mean / M2."""
+    n = stats["n"]
+    if n <= 1:
+        stats["mean"][:] = 0
+        stats["m2"][:] = 0
+        stats["n"] = 0
+        return
+    old_mean = stats["mean"].copy()
+    stats["mean"] = (n * old_mean - volume) / (n - 1)
+    stats["m2"] -= (volume - stats["mean"]) * (volume - old_mean)
+    np.maximum(stats["m2"], 0, out=stats["m2"])
+    stats["n"] = n - 1
+
+
+def save_stats(stats, stats_path):
+    members = sorted(stats["members"].items())
+    tmp = stats_path + ".tmp.npz"
+    np.savez(tmp, n=stats["n"], mean=stats["mean"], m2=stats["m2"], affine=stats["affine"],
+             member_paths=np.array([p for p, _ in members], dtype=str),
+             member_stamps=np.array([s for _, s in members], dtype=str))
+    os.replace(tmp, stats_path)
+
+
+def load_stats(stats_path):
+    with np.load(stats_path) as f:
+        return {"n": int(f["n"]), "mean": f["mean"], "m2": f["m2"], "affine": f["affine"],
+                "members": dict(zip(f["member_paths"].tolist(), f["member_stamps"].tolist()))}
+
+
+def build_template(control_dir, template_path="hn_template.nii", stats_path=None, sd_path=None,
+                   exclude=(), chunk_size=4, rebuild=False):
+    """Mean (and voxelwise SD) template of all controls, updated incrementally.
+
+    The count, mean and sum of squared deviations are saved next to the
+    template; later runs only stream in new controls and take excluded ones
+    back out. A control that changed on disk or disappeared forces a rebuild,
+    since its old contribution can no longer be subtracted.
+    """
+    base = template_path[:-4] if template_path.endswith(".nii") else template_path
+    stats_path = stats_path or base + "_stats.npz"
+    sd_path = sd_path or base + "_sd.nii"
+
+    exclude = {os.path.abspath(p) for p in exclude}
+    controls = [p for p in find_controls(control_dir) if p not in exclude]
+    if not controls:
+        raise ValueError("No wr_petsuv.nii files found in the specified directory.")
+    ref = load_nifti(controls[0])
+
+    stats = None
+    if os.path.exists(stats_path) and not rebuild:
+        stats = load_stats(stats_path)
+        members = stats["members"]
+        stale = [p for p in members if not os.path.exists(p) or file_stamp(p) != members[p]]
+        if stale or stats["mean"].shape != ref.shape[:3]:
+            print(f"{len(stale)} control(s) changed or vanished since the last run → rebuilding")
+            stats = None
+    if stats is None:
+        stats = empty_stats(ref.shape[:3], ref.affine)
+
+    # Take excluded controls back out, one at a time
+    for p in [p for p in stats["members"] if p in exclude]:
+        remove_volume(stats, load_volume(p))
+        del stats["members"][p]
+        print(f"Removed {p}")
+
+    # Stream new controls in chunks so memory stays at chunk_size volumes
+    to_add = [p for p in controls if p not in stats["members"]]
+    for start in range(0, len(to_add), chunk_size):
+        paths = to_add[start:start + chunk_size]
+        add_chunk(stats, np.stack([load_volume(p) for p in paths]))
+        for p in paths:
+            stats["members"][p] = file_stamp(p)
+            print(f"Added {p}")
+
+    save_stats(stats, stats_path)
+
+    n = stats["n"]
+    sd = np.sqrt(stats["m2"] / (n - 1)) if n > 1 else np.zeros_like(stats["m2"])
+    for data, out_path in ((stats["mean"], template_path), (sd, sd_path)):
+        header = ref.header.copy()
+        header.set_data_dtype(np.float32)
+        nib.save(nib.Nifti1Image(data.astype(np.float32), stats["affine"], header), out_path)
+
+    print(f"Average template of {n} controls saved as {template_path} (SD map: {sd_path})")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incremental mean / SD control template (create_hn_template.m).")
+    parser.add_argument("control_dir")
+    parser.add_argument("--template", default="hn_template.nii")
+    parser.add_argument("--exclude", nargs="*", default=[], help="controls to leave out of the template")
+    parser.add_argument("--chunk-size", type=int, default=4)
+    parser.add_argument("--rebuild", action="store_true", help="ignore the saved statistics")
+    args = parser.parse_args()
+
+    build_template(args.control_dir, args.template, exclude=args.exclude,
+                   chunk_size=args.chunk_size, rebuild=args.rebuild)
@@ -1,15 +1,24 @@
 import os
 import json
+import argparse
 from pathlib import Path
-import nibabel as nib
 import numpy as np
 import pandas as pd
-from scipy.ndimage import mean as nd_mean
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait
 import matplotlib.pyplot as plt
+from atlas_cache import load_atlas_index, flat_view
+from volume_cache import load_nifti
+from manifest import as_manifest
+from provenance import input_signature, RowCache, deps_path
+from roi_stats import update_roi_stats, stats_path
+from atlas_resample import native_label_index, structures_transform
+import instrumentation
+from instrumentation import stage
 
-def find_files(root_folder, target_name):
-    """Recursively find all files with a given name."""
+def find_files(root_folder, target_name, manifest=None):
+    """Recursively find all files with a given name (or look them up in a manifest)."""
+    if manifest is not None:
+        return as_manifest(manifest).find(target_name, under=root_folder)
     matches = []
     for dirpath, dirnames, filenames in os.walk(root_folder):
         for filename in filenames:
@@ -17,22 +26,30 @@ def find_files(root_folder, target_name):
                 matches.append(os.path.join(dirpath, filename))
     return matches
 
-def save_qc_overlay(volume, pons, subject_id, root):
-    parent = os.path.dirname(root)
-    qc_dir = os.path.join(parent, 'QC')
-    os.makedirs(qc_dir, exist_ok=True)
+def qc_dir_for(root):
+    return os.path.join(os.path.dirname(root), 'QC')
 
+def qc_slices(volume, pons):
+    """Middle axial slice of the pons region, as (z, volume slice, pons slice) or None."""
     # find z indices where pons > 0
     z_indices = np.where(np.any(pons > 0, axis=(0, 1)))[0]
     if len(z_indices) == 0:
-        print(f"[QC] No pons voxels found for {subject_id}")
-        return
+        return None
     z_mid = int(np.median(z_indices))  # middle slice of pons region
+    return z_mid, np.array(volume[:, :, z_mid]), np.array(pons[:, :, z_mid] > 0, dtype=np.uint8)
+
+def render_qc_overlay(z_mid, volume_slice, pons_slice, subject_id, qc_dir):
+    """Render the pons overlay of one subject from its 2D slices."""
+    with stage(subject_id, "qc_render"):
+        return _render_qc_overlay(z_mid, volume_slice, pons_slice, subject_id, qc_dir)
+
+def _render_qc_overlay(z_mid, volume_slice, pons_slice, subject_id, qc_dir):
+    os.makedirs(qc_dir, exist_ok=True)
 
     # plot overlay
     plt.figure(figsize=(6, 6))
-    plt.imshow(volume[:, :, z_mid].T, cmap="gray", origin="lower")
-    plt.imshow(np.ma.masked_where(pons[:, :, z_mid].T == 0, pons[:, :, z_mid].T),
+    plt.imshow(volume_slice.T, cmap="gray", origin="lower")
+    plt.imshow(np.ma.masked_where(pons_slice.T == 0, pons_slice.T),
                cmap="autumn", alpha=0.5, origin="lower")
     plt.title(f"{subject_id} (z={z_mid})")
     plt.axis("off")
@@ -41,9 +58,17 @@ def save_qc_overlay(volume, pons, subject_id, root):
     outpath = os.path.join(qc_dir, f"{subject_id}_qc.png")
     plt.savefig(outpath, bbox_inches="tight")
     plt.close()
+    return outpath
 
-def calculate_roi_single(file, labels, names, atlas_folder, root='forROIanalyses/DLB'):
-    """Calculate ROI values for a single file."""
+def save_qc_overlay(volume, pons, subject_id, root):
+    slices = qc_slices(volume, pons)
+    if slices is None:
+        print(f"[QC] No pons voxels found for {subject_id}")
+        return
+    render_qc_overlay(*slices, subject_id, qc_dir_for(root))
+
+def subject_paths(file, atlas_folder):
+    """Subject ID and native atlas/pons paths derived from the group/IPP/date folders."""
     path = Path(file)
     date = path.parent.name
     ipp = path.parent.parent.name
@@ -56,32 +81,74 @@ def calculate_roi_single(file, labels, names, atlas_folder, root='forROIanalyses
 
     pons_basename = f"wfu_pons_native_{group}_{ipp}_{date}.nii.gz"
     pons_path = Path(atlas_folder) / pons_basename
+    return subject_id, atlas_path, pons_path
 
-    # Load NIfTI volumes
-    volume = nib.load(file).get_fdata(dtype=np.float32)
-    atlas = nib.load(atlas_path).get_fdata(dtype=np.float32).astype(np.int32)
-    pons = nib.load(pons_path).get_fdata(dtype=np.float32).astype(np.int32)
+def load_pons_index(file, atlas_folder, pons_template=None):
+    """Native pons mask of a subject: its wfu_pons_native file or, when that is missing and a
+    template is given, the template resampled onto the native structures and cut to label 35."""
+    subject_id, atlas_path, pons_path = subject_paths(file, atlas_folder)
+    if pons_template is None or os.path.exists(pons_path):
+        return load_atlas_index(pons_path)
+    return native_label_index(pons_template, str(atlas_path), structures_transform(atlas_folder, subject_id))
 
-    save_qc_overlay(volume, pons, subject_id, root)
+def calculate_roi_single(file, labels, names, atlas_folder, return_qc=False, pons_template=None):
+    """Calculate ROI values for a single file.
 
-    # ROI means from atlas
-    means = nd_mean(volume, labels=atlas, index=labels)
+    With return_qc, also return the 2D slices needed for the QC overlay
+    (None if there is no pons), so rendering can happen elsewhere.
+    """
+    subject_id, atlas_path, pons_path = subject_paths(file, atlas_folder)
 
-    row = {"subject_id": subject_id, "file": str(file)}
-    for name, val in zip(names, means):
-        row[name] = float(val) if not np.isnan(val) else np.nan
+    # Load NIfTI volumes
+    with stage(subject_id, "load"):
+        volume = load_nifti(file).get_fdata(dtype=np.float32)
+    with stage(subject_id, "atlas"):
+        atlas = load_atlas_index(atlas_path)
+        pons = load_pons_index(file, atlas_folder, pons_template)
 
-    # Pons mean (mask > 0)
-    if np.any(pons > 0):
-        pons_mean = volume[pons > 0].mean()
-    else:
-        pons_mean = np.nan
-    row["Pons"] = float(pons_mean)
+    # Flat voxel indices are only valid on the grid the atlas and pons were compiled on
+    for name, index in (("atlas", atlas), ("pons", pons)):
+        if volume.shape[:3] != index.shape:
+            raise ValueError(f"{file} has shape {volume.shape}, {name} has shape {index.shape}")
 
+    # ROI means from atlas, one fancy-index per label
+    with stage(subject_id, "reduce"):
+        flat = flat_view(volume)
+        row = {"subject_id": subject_id, "file": str(file)}
+        for label, name in zip(labels, names):
+            values = flat[atlas.voxels(label)]
+            row[name] = float(values.mean(dtype=np.float64)) if values.size > 0 else np.nan
+
+        # Pons mean (mask > 0)
+        values = flat[pons.mask_voxels()]
+        row["Pons"] = float(values.mean()) if values.size > 0 else np.nan
+
+    if return_qc:
+        with stage(subject_id, "qc_slices"):
+            slices = qc_slices(volume, pons.mask())
+        return row, slices
     return row
 
-def calculate_rois_parallel(list_files, json_file, atlas_folder="results_assembly", output_excel="roi_results.xlsx", root='forROIanalyses/DLB', n_workers=4):
-    """Parallel ROI calculation."""
+def roi_signature(file, labels, names, atlas_folder, pons_template=None):
+    """Input signature of one subject's row: PET, native atlas and pons files plus the label set."""
+    subject_id, atlas_path, pons_path = subject_paths(file, atlas_folder)
+    paths = [file, atlas_path, pons_path]
+    if pons_template is not None:
+        paths += [pons_template, Path(atlas_folder) / f"matrix_affine_native_to_mni_{subject_id}.txt"]
+    return input_signature(paths, labels=labels, names=names)
+
+def calculate_rois_parallel(list_files, json_file, atlas_folder="results_assembly", output_excel="roi_results.xlsx",
+                            root='forROIanalyses/DLB', n_workers=4, qc=True, qc_workers=2, incremental=True,
+                            pons_template=None):
+    """Parallel ROI calculation.
+
+    QC overlays are rendered on a separate pool from the 2D slices returned
+    by the ROI workers, and the Excel file is written before waiting on them.
+    With incremental, subjects whose inputs are unchanged since the last run
+    (see <output_excel>.deps.json) are taken from the previous results.
+    With pons_template (e.g. wfu_pons.nii), subjects without a
+    wfu_pons_native file get their pons mask resampled in memory.
+    """
     # Load atlas definition
     with open(json_file, "r") as f:
         atlas_def = json.load(f)["structures"]
@@ -89,31 +156,104 @@ def calculate_rois_parallel(list_files, json_file, atlas_folder="results_assembl
     labels = [s["label"] for s in atlas_def]
     names = [s["name"] for s in atlas_def]
 
-    results = []
+    deps = RowCache(deps_path(output_excel))
+    previous = {k: e["row"] for k, e in deps.entries.items()}
+    signatures = {str(f): roi_signature(f, labels, names, atlas_folder, pons_template) for f in list_files}
+    done = {}
+    if incremental:
+        for f, signature in signatures.items():
+            row = deps.get(f, signature)
+            if row is not None:
+                done[f] = row
+    todo = [f for f in list_files if str(f) not in done]
+    print(f"{len(done)} subjects unchanged, {len(todo)} to process")
+
+    qc_futures = []
+    qc_executor = ProcessPoolExecutor(max_workers=qc_workers) if qc and todo else None
 
     # Parallel processing
     with ProcessPoolExecutor(max_workers=n_workers) as executor:
-        futures = {executor.submit(calculate_roi_single, f, labels, names, atlas_folder): f for f in list_files}
+        futures = {executor.submit(calculate_roi_single, f, labels, names, atlas_folder, qc, pons_template): f for f in todo}
         for future in as_completed(futures):
-            row = future.result()
-            results.append(row)
+            if qc:
+                row, slices = future.result()
+                if slices is None:
+                    print(f"[QC] No pons voxels found for {row['subject_id']}")
+                else:
+                    qc_futures.append(qc_executor.submit(render_qc_overlay, *slices, row["subject_id"], qc_dir_for(root)))
+            else:
+                row = future.result()
+            f = str(futures[future])
+            done[f] = row
+            deps.put(f, signatures[f], row)
             print(row)
 
-    # Save results
+    # Save results, previous rows merged back in discovery order
+    results = [done[str(f)] for f in list_files if str(f) in done]
     df = pd.DataFrame(results)
-    df.to_excel(output_excel, index=False)
+    with stage("run", "excel"):
+        df.to_excel(output_excel, index=False)
     print(f"Saved ROI results to {output_excel}")
+    deps.prune(signatures)
+    deps.save()
+    update_roi_stats(stats_path(output_excel), {str(f): done[str(f)] for f in list_files if str(f) in done},
+                     previous, lambda row: Path(row["file"]).parent.parent.parent.name, names + ["Pons"])
+
+    if qc_executor is not None:
+        wait(qc_futures)
+        for future in qc_futures:
+            future.result()
+        qc_executor.shutdown()
+        print(f"Saved {len(qc_futures)} QC overlays to {qc_dir_for(root)}")
+    instrumentation.summarize()
     return df
 
+def _qc_task(file, atlas_folder, pons_template=None):
+    subject_id, _, _ = subject_paths(file, atlas_folder)
+    volume = load_nifti(file).get_fdata(dtype=np.float32)
+    return subject_id, qc_slices(volume, load_pons_index(file, atlas_folder, pons_template).mask())
+
+def render_qc_parallel(list_files, atlas_folder="results_assembly", root='forROIanalyses/DLB', n_workers=4,
+                       pons_template=None):
+    """QC overlays as a stand-alone stage, after the ROI values are computed."""
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_qc_task, f, atlas_folder, pons_template) for f in list_files]
+        for future in as_completed(futures):
+            subject_id, slices = future.result()
+            if slices is None:
+                print(f"[QC] No pons voxels found for {subject_id}")
+                continue
+            print(f"[QC] {render_qc_overlay(*slices, subject_id, qc_dir_for(root))}")
+
 def main():
-    root_folder = "coreg_center_mass_reorient/HC"
-    target_filename = "pons_r_petsuv.nii.gz"
-    atlas_json = "results_assembly/structures.json"
-    atlas_folder = "results_assembly"
-    output_excel = "coreg_center_mass_reorient/results_roi/pons_r_petsuv_HC.xlsx"
-
-    list_files = find_files(root_folder, target_filename)
-    df_results = calculate_rois_parallel(list_files, atlas_json, atlas_folder, output_excel, root_folder, n_workers=8)
+    parser = argparse.ArgumentParser(description="Native-space ROI means with optional pons QC overlays.")
+    parser.add_argument("--root", default="coreg_center_mass_reorient/HC")
+    parser.add_argument("--target", default="pons_r_petsuv.nii.gz")
+    parser.add_argument("--atlas-json", default="results_assembly/structures.json")
+    parser.add_argument("--atlas-folder", default="results_assembly")
+    parser.add_argument("--output", default="coreg_center_mass_reorient/results_roi/pons_r_petsuv_HC.xlsx")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--qc-workers", type=int, default=2)
+    parser.add_argument("--manifest", default=None, help="saved manifest to look files up in instead of walking")
+    parser.add_argument("--force", action="store_true", help="recompute every subject, even if unchanged")
+    parser.add_argument("--profile", default=None, help="write per-subject stage timings to this JSON-lines file")
+    parser.add_argument("--pons-template", default=None,
+                        help="pons atlas (e.g. wfu_pons.nii) to resample for subjects without wfu_pons_native")
+    qc_mode = parser.add_mutually_exclusive_group()
+    qc_mode.add_argument("--no-qc", action="store_true", help="skip QC overlays")
+    qc_mode.add_argument("--qc-only", action="store_true", help="only render QC overlays")
+    args = parser.parse_args()
+    if args.profile:
+        instrumentation.enable(args.profile)
+
+    list_files = find_files(args.root, args.target, args.manifest)
+    if args.qc_only:
+        render_qc_parallel(list_files, args.atlas_folder, args.root, n_workers=args.workers,
+                           pons_template=args.pons_template)
+        return
+    df_results = calculate_rois_parallel(list_files, args.atlas_json, args.atlas_folder, args.output, args.root,
+                                         n_workers=args.workers, qc=not args.no_qc, qc_workers=args.qc_workers,
+                                         incremental=not args.force, pons_template=args.pons_template)
 
 if __name__ == "__main__":
     main()
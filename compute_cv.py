@@ -1,19 +1,26 @@
-import pandas as pd
+import os
+from roi_stats import RoiStats, stats_path
+from excel_cache import read_excel
 
 # Load your Excel file
 file_path = "forROIanalyses/roi_results_DLB.xlsx"  # replace with your file path
-df = pd.read_excel(file_path)
 
-# If your Excel has a column for subject IDs, drop it for CV calculation
-# For example, assume the first column is 'SubjectID'
-roi_data = df.iloc[:, 2:]  # all columns except the first
+if os.path.exists(stats_path(file_path)):
+    # Sufficient statistics kept up to date by calculate_rois.py, no need to reload the table
+    roi_cv = RoiStats(stats_path(file_path)).summary()["cv"]
+else:
+    df = read_excel(file_path)
 
-# Compute mean and standard deviation for each ROI
-roi_mean = roi_data.mean()
-roi_std = roi_data.std()
+    # If your Excel has a column for subject IDs, drop it for CV calculation
+    # For example, assume the first column is 'SubjectID'
+    roi_data = df.iloc[:, 2:]  # all columns except the first
 
-# Compute coefficient of variation (CV = std / mean)
-roi_cv = roi_std / roi_mean
+    # Compute mean and standard deviation for each ROI
+    roi_mean = roi_data.mean()
+    roi_std = roi_data.std()
+
+    # Compute coefficient of variation (CV = std / mean)
+    roi_cv = roi_std / roi_mean
 
 # Sort ROIs by CV (lowest first)
 roi_cv_sorted = roi_cv.sort_values()
@@ -0,0 +1,113 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+# Converted workbooks live here, one sub-folder per (workbook path, size, mtime)
+CACHE_DIR = os.environ.get("XLSX_CACHE_DIR", ".xlsx_cache")
+
+
+def _path_prefix(path):
+    return hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+
+
+def _entry_for(path, cache_dir):
+    st = os.stat(path)
+    stamp = hashlib.sha1(f"{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{_path_prefix(path)}_{stamp}")
+
+
+def _convert(path, entry, cache_dir):
+    """Parse every sheet once and store each column as its own .npy file."""
+    sheets = pd.read_excel(path, sheet_name=None)
+    tmp = os.path.join(cache_dir, f".{os.path.basename(entry)}.{uuid.uuid4().hex}")
+    os.makedirs(tmp)
+    meta = {"source": os.path.abspath(path), "sheets": []}
+    for s, (sheet_name, df) in enumerate(sheets.items()):
+        columns = []
+        for c, col in enumerate(df.columns):
+            values = df[col].to_numpy()
+            filename = f"s{s}_c{c}.npy"
+            np.save(os.path.join(tmp, filename), values, allow_pickle=values.dtype == object)
+            columns.append({"name": col, "file": filename})
+        meta["sheets"].append({"name": sheet_name, "columns": columns})
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f, default=str)
+    try:
+        os.rename(tmp, entry)
+        print(f"Cached {path} → {entry}")
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)  # another process converted it first
+
+    # Older versions of the same workbook are stale
+    prefix = _path_prefix(path) + "_"
+    for name in os.listdir(cache_dir):
+        if name.startswith(prefix) and os.path.join(cache_dir, name) != entry:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+
+class CachedWorkbook:
+    """Columnar cache of an .xlsx file with a column → sheet index."""
+
+    def __init__(self, path, cache_dir=None):
+        cache_dir = cache_dir or CACHE_DIR
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = path
+        self.entry = _entry_for(path, cache_dir)
+        if not os.path.exists(os.path.join(self.entry, "meta.json")):
+            _convert(path, self.entry, cache_dir)
+        with open(os.path.join(self.entry, "meta.json"), "r") as f:
+            self.sheets = json.load(f)["sheets"]
+
+    @property
+    def sheet_names(self):
+        return [s["name"] for s in self.sheets]
+
+    def _sheet(self, sheet_name):
+        if isinstance(sheet_name, int):
+            return self.sheets[sheet_name]
+        for sheet in self.sheets:
+            if sheet["name"] == sheet_name:
+                return sheet
+        raise ValueError(f"Worksheet named '{sheet_name}' not found in {self.path}")
+
+    def _load(self, column):
+        filename = os.path.join(self.entry, column["file"])
+        try:
+            return np.load(filename, mmap_mode="r")
+        except ValueError:
+            return np.load(filename, allow_pickle=True)  # object (text / mixed) column
+
+    def find_column(self, column):
+        """Name of the first sheet holding column, or None."""
+        for sheet in self.sheets:
+            if any(c["name"] == column for c in sheet["columns"]):
+                return sheet["name"]
+        return None
+
+    def read(self, sheet_name=0, columns=None):
+        """DataFrame of one sheet, reading only the requested columns."""
+        sheet = self._sheet(sheet_name)
+        wanted = sheet["columns"] if columns is None else \
+            [c for name in columns for c in sheet["columns"] if c["name"] == name]
+        return pd.DataFrame({c["name"]: np.array(self._load(c)) for c in wanted},
+                            columns=[c["name"] for c in wanted])
+
+    def read_column(self, column):
+        """Series of the first sheet holding column, or None."""
+        sheet_name = self.find_column(column)
+        if sheet_name is None:
+            return None
+        return self.read(sheet_name, [column])[column]
+
+
+def read_excel(path, sheet_name=0, columns=None, cache_dir=None):
+    """Drop-in for pd.read_excel(path, sheet_name) backed by the columnar cache."""
+    return CachedWorkbook(path, cache_dir).read(sheet_name, columns)
+
+
+def find_column(path, column, cache_dir=None):
+    return CachedWorkbook(path, cache_dir).find_column(column)
@@ -1,85 +1,310 @@
 import os
 import json
-import nibabel as nib
+import sys
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from atlas_cache import load_atlas_index, flat_view
+from volume_cache import load_nifti
+from manifest import as_manifest
+from provenance import input_signature, RowCache, deps_path
+from results_store import subject_key
+from roi_stats import update_roi_stats, stats_path
+import instrumentation
+from instrumentation import stage
 
-def compute_averages(root_dir, aal_json_path, output_xlsx="aal_pet_values.xlsx"):
-    # Load AAL region labels
+# Tissue class of each voxel, combined with the region index into one bincount key
+# 0: neither, 1: GM > threshold, 2: WM > threshold but not GM
+N_TISSUE_CLASSES = 3
+
+COMPOSITE_REGIONS = ["Cerebellum", "Vermis", "Whole_Cerebellum"]
+
+
+def grouped_region_sums(pet_vals, region_idx, tissue_class, n_regions):
+    """Sum and voxel count of pet_vals per (region, tissue class) in one pass."""
+    key = region_idx.ravel() * N_TISSUE_CLASSES + tissue_class.ravel()
+    size = n_regions * N_TISSUE_CLASSES
+    sums = np.bincount(key, weights=pet_vals.ravel(), minlength=size)
+    counts = np.bincount(key, minlength=size)
+    return sums.reshape(n_regions, N_TISSUE_CLASSES), counts.reshape(n_regions, N_TISSUE_CLASSES)
+
+
+def _safe_mean(total, count):
+    return float(total / count) if count > 0 else np.nan
+
+
+def load_aal_atlas(aal_json_path, aal_path="r_aal.nii"):
+    """Load the AAL labels and the cached voxel index of the atlas."""
     with open(aal_json_path, "r") as f:
         aal_dict = json.load(f)
 
     region_names = list(aal_dict.values())
-    results = []
-    aal_path = "r_aal.nii"
-    aal_img = nib.load(aal_path).get_fdata().astype(int)
+    index = load_atlas_index(aal_path)
+
+    # Compact region index of every labelled atlas voxel (0 = not an AAL region)
+    region_of_label = {int(k): i for i, k in enumerate(aal_dict.keys(), start=1)}
+    label_regions = np.array([region_of_label.get(int(l), 0) for l in index.labels], dtype=np.intp)
+    voxel_regions = np.repeat(label_regions, np.diff(index.indptr))
+
+    # Cerebellar labels use GM ∪ WM, all others GM only
+    is_cerebellum = np.array([v.startswith("Cerebellum") for v in region_names])
+    is_vermis = np.array([v.startswith("Vermis") for v in region_names])
 
-    # Precompute indices for new meta-regions
-    cerebellum_indices = [int(k) for k, v in aal_dict.items() if v.startswith("Cerebellum")]
-    vermis_indices = [int(k) for k, v in aal_dict.items() if v.startswith("Vermis")]
-    whole_cereb_indices = cerebellum_indices + vermis_indices
+    return {
+        "path": aal_path,
+        "key": index.key,
+        "shape": index.shape,
+        "region_names": region_names,
+        "voxels": index.indices,
+        "voxel_regions": voxel_regions,
+        "n_regions": len(region_names) + 1,
+        "is_cerebellum": is_cerebellum,
+        "is_vermis": is_vermis,
+    }
 
-    # Walk through all nested directories for wr_petsuv.nii
+
+def find_scans(root_dir, manifest=None):
+    """Walk through all nested directories for wr_petsuv.nii (or look them up in a manifest)."""
+    if manifest is not None:
+        return as_manifest(manifest).find("wr_petsuv.nii", under=root_dir)
+    scans = []
     for dirpath, _, filenames in os.walk(root_dir):
         if "wr_petsuv.nii" in filenames:
-            pet_path = os.path.join(dirpath, "wr_petsuv.nii")
-            gm_path = os.path.join(dirpath, "mri", "wp1mri.nii")
-            wm_path = os.path.join(dirpath, "mri", "wp2mri.nii")
+            scans.append(os.path.join(dirpath, "wr_petsuv.nii"))
+    return scans
 
-            if not (os.path.exists(aal_path) and os.path.exists(gm_path) and os.path.exists(wm_path)):
-                print(f"Skipping {pet_path}, missing one of AAL/GM/WM files")
-                continue
 
-            pet_img = nib.load(pet_path).get_fdata()
-            gm_img = nib.load(gm_path).get_fdata()
-            wm_img = nib.load(wm_path).get_fdata()
+def tissue_paths(pet_path):
+    dirpath = os.path.dirname(pet_path)
+    return os.path.join(dirpath, "mri", "wp1mri.nii"), os.path.join(dirpath, "mri", "wp2mri.nii")
 
-            gm_mask = gm_img > 0.7
-            wm_mask = wm_img > 0.7
 
-            scan_result = {"scan_path": pet_path}
+def scan_signature(pet_path, atlas_key, region_names, tissue_threshold):
+    """Input signature of one scan's row: PET and tissue maps, atlas identity and threshold."""
+    return input_signature([pet_path, *tissue_paths(pet_path)], atlas=atlas_key, regions=region_names,
+                           tissue_threshold=tissue_threshold)
 
-            # Iterate over each AAL region
-            for idx, region_name in aal_dict.items():
-                idx = int(idx)
-                region_mask = aal_img == idx
 
-                if region_name.startswith("Vermis") or region_name.startswith("Cerebellum"):
-                    mask = region_mask & (gm_mask | wm_mask)
-                else:
-                    mask = region_mask & gm_mask
+def compute_scan_averages(pet_path, atlas, tissue_threshold=0.7):
+    """AAL region and composite means for a single scan, or None if inputs are missing."""
+    gm_path, wm_path = tissue_paths(pet_path)
 
-                values = pet_img[mask]
-                scan_result[region_name] = float(values.mean()) if values.size > 0 else np.nan
+    if not (os.path.exists(atlas["path"]) and os.path.exists(gm_path) and os.path.exists(wm_path)):
+        print(f"Skipping {pet_path}, missing one of AAL/GM/WM files")
+        return None
 
-            # ---- Add composite regions ----
-            # Cerebellum
-            cereb_mask = np.isin(aal_img, cerebellum_indices) & (gm_mask | wm_mask)
-            values = pet_img[cereb_mask]
-            scan_result["Cerebellum"] = float(values.mean()) if values.size > 0 else np.nan
+    # One fancy-index per volume gathers every atlas voxel
+    voxels = atlas["voxels"]
+    with stage(pet_path, "load"):
+        images = [load_nifti(p) for p in (pet_path, gm_path, wm_path)]
+        for path, img in zip((pet_path, gm_path, wm_path), images):
+            # Flat voxel indices are only valid on the atlas grid
+            if img.shape[:3] != atlas["shape"]:
+                print(f"Warning: {path} has shape {img.shape}, atlas has shape {atlas['shape']} → skipping")
+                return None
+        pet_vals, gm_vals, wm_vals = (flat_view(img.get_fdata())[voxels] for img in images)
 
-            # Vermis
-            vermis_mask = np.isin(aal_img, vermis_indices) & (gm_mask | wm_mask)
-            values = pet_img[vermis_mask]
-            scan_result["Vermis"] = float(values.mean()) if values.size > 0 else np.nan
+    with stage(pet_path, "mask"):
+        gm_mask = gm_vals > tissue_threshold
+        wm_mask = wm_vals > tissue_threshold
+        tissue_class = np.where(gm_mask, 1, np.where(wm_mask, 2, 0))
 
-            # Whole cerebellum (Cerebellum + Vermis)
-            whole_cereb_mask = np.isin(aal_img, whole_cereb_indices) & (gm_mask | wm_mask)
-            values = pet_img[whole_cereb_mask]
-            scan_result["Whole_Cerebellum"] = float(values.mean()) if values.size > 0 else np.nan
+    with stage(pet_path, "reduce"):
+        return _region_means(pet_path, pet_vals, tissue_class, atlas)
 
-            results.append(scan_result)
-            print(f"Processed {pet_path}")
 
+def _region_means(pet_path, pet_vals, tissue_class, atlas):
+    # Sums and counts of every region in a single pass over the voxels
+    sums, counts = grouped_region_sums(pet_vals, atlas["voxel_regions"], tissue_class, atlas["n_regions"])
+    gm_sums, gm_counts = sums[1:, 1], counts[1:, 1]
+    gmwm_sums, gmwm_counts = sums[1:, 1] + sums[1:, 2], counts[1:, 1] + counts[1:, 2]
+
+    is_cerebellum, is_vermis = atlas["is_cerebellum"], atlas["is_vermis"]
+    gm_or_wm_labels = is_cerebellum | is_vermis
+    region_sums = np.where(gm_or_wm_labels, gmwm_sums, gm_sums)
+    region_counts = np.where(gm_or_wm_labels, gmwm_counts, gm_counts)
+
+    scan_result = {"scan_path": pet_path}
+    for region_name, total, count in zip(atlas["region_names"], region_sums, region_counts):
+        scan_result[region_name] = _safe_mean(total, count)
+
+    # ---- Add composite regions from the per-label GM ∪ WM totals ----
+    for name, members in zip(COMPOSITE_REGIONS, (is_cerebellum, is_vermis, gm_or_wm_labels)):
+        scan_result[name] = _safe_mean(gmwm_sums[members].sum(), gmwm_counts[members].sum())
+
+    return scan_result
+
+
+def _group_of(row):
+    return subject_key(row["scan_path"])[0]
+
+
+def _save_results(results, region_names, output_xlsx):
     # Add new composite region names to columns
-    df = pd.DataFrame(results, columns=["scan_path"] + region_names + ["Cerebellum", "Vermis", "Whole_Cerebellum"])
+    df = pd.DataFrame(results, columns=["scan_path"] + region_names + COMPOSITE_REGIONS)
 
     # Save Excel
-    df.to_excel(output_xlsx, index=False)
+    with stage("run", "excel"):
+        df.to_excel(output_xlsx, index=False)
     print(f"Saved results to {output_xlsx}")
+    return df
+
+
+def compute_averages(root_dir, aal_json_path, output_xlsx="aal_pet_values.xlsx", manifest=None,
+                     tissue_threshold=0.7, incremental=True):
+    """AAL means of every scan; with incremental, unchanged scans are reused from <output_xlsx>.deps.json."""
+    atlas = load_aal_atlas(aal_json_path)
+    deps = RowCache(deps_path(output_xlsx))
+    previous = {k: e["row"] for k, e in deps.entries.items()}
+
+    results = []
+    signatures = {}
+    for pet_path in find_scans(root_dir, manifest):
+        signature = scan_signature(pet_path, atlas["key"], atlas["region_names"], tissue_threshold)
+        signatures[pet_path] = signature
+        scan_result = deps.get(pet_path, signature) if incremental else None
+        if scan_result is None:
+            scan_result = compute_scan_averages(pet_path, atlas, tissue_threshold)
+            if scan_result is None:
+                continue
+            deps.put(pet_path, signature, scan_result)
+            print(f"Processed {pet_path}")
+        results.append(scan_result)
+
+    df = _save_results(results, atlas["region_names"], output_xlsx)
+    deps.prune(signatures)
+    deps.save()
+    update_roi_stats(stats_path(output_xlsx), {r["scan_path"]: r for r in results}, previous, _group_of,
+                     atlas["region_names"] + COMPOSITE_REGIONS)
+    instrumentation.summarize()
+    return df
+
+
+# ---- Parallel, resumable mode ----
+_worker_atlas = None
+
+
+def _init_worker(aal_json_path, aal_path):
+    # Each worker loads the atlas once instead of receiving it with every task
+    global _worker_atlas
+    _worker_atlas = load_aal_atlas(aal_json_path, aal_path)
+
+
+def _compute_in_worker(pet_path, tissue_threshold):
+    return compute_scan_averages(pet_path, _worker_atlas, tissue_threshold)
+
+
+def checkpoint_params(aal_json_path, region_names, atlas_key, tissue_threshold):
+    """Settings a checkpoint was written with, stored in its first line."""
+    return {"aal_json": os.path.abspath(aal_json_path), "regions": region_names, "atlas": atlas_key,
+            "tissue_threshold": tissue_threshold}
+
+
+def load_checkpoint(checkpoint_path, params):
+    """Rows already written to a partial-results file, keyed by scan path.
+
+    A checkpoint written with other params (atlas JSON, atlas or threshold),
+    or without a params line, is deleted instead of resumed.
+    """
+    done = {}
+    if not os.path.exists(checkpoint_path):
+        return done
+    with open(checkpoint_path, "r") as f:
+        try:
+            header = json.loads(f.readline())
+        except json.JSONDecodeError:
+            header = None
+        stale = not isinstance(header, dict) or header.get("params") != json.loads(json.dumps(params))
+        for line in ([] if stale else f):
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line may be truncated if the previous run was killed mid-write
+                continue
+            done[row["scan_path"]] = row
+    if stale:
+        print(f"Discarding {checkpoint_path}: written with another atlas or tissue threshold")
+        os.remove(checkpoint_path)
+    return done
+
+
+def compute_averages_parallel(root_dir, aal_json_path, output_xlsx="aal_pet_values.xlsx",
+                              n_workers=4, checkpoint_path=None, aal_path="r_aal.nii", manifest=None,
+                              tissue_threshold=0.7, incremental=True):
+    """Parallel AAL extraction that checkpoints each subject and resumes from the checkpoint.
+
+    With incremental, scans whose inputs are unchanged since the last
+    completed run are reused from <output_xlsx>.deps.json.
+    """
+    if checkpoint_path is None:
+        checkpoint_path = output_xlsx + ".partial.jsonl"
+
+    with open(aal_json_path, "r") as f:
+        region_names = list(json.load(f).values())
+    atlas_key = load_atlas_index(aal_path).key
+
+    scans = find_scans(root_dir, manifest)
+    signatures = {p: scan_signature(p, atlas_key, region_names, tissue_threshold) for p in scans}
+    deps = RowCache(deps_path(output_xlsx))
+    previous = {k: e["row"] for k, e in deps.entries.items()}
+    unchanged = {}
+    if incremental:
+        for p, signature in signatures.items():
+            row = deps.get(p, signature)
+            if row is not None:
+                unchanged[p] = row
+    params = checkpoint_params(aal_json_path, region_names, atlas_key, tissue_threshold)
+    done = load_checkpoint(checkpoint_path, params)
+    done.update(unchanged)
+    todo = [p for p in scans if p not in done]
+    print(f"{len(unchanged)} scans unchanged, {len(done) - len(unchanged)} restored from {checkpoint_path}, "
+          f"{len(todo)} to process")
+
+    with open(checkpoint_path, "a+b") as checkpoint:
+        if checkpoint.tell() == 0:
+            checkpoint.write((json.dumps({"params": params}) + "\n").encode())
+        else:
+            # Terminate a truncated last line so new rows start on their own line
+            checkpoint.seek(-1, os.SEEK_END)
+            if checkpoint.read(1) != b"\n":
+                checkpoint.write(b"\n")
+
+    with open(checkpoint_path, "a") as checkpoint, \
+         ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                             initargs=(aal_json_path, aal_path)) as executor:
+        futures = {executor.submit(_compute_in_worker, p, tissue_threshold): p for p in todo}
+        for future in as_completed(futures):
+            scan_result = future.result()
+            if scan_result is None:
+                continue
+            checkpoint.write(json.dumps(scan_result) + "\n")
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+            done[scan_result["scan_path"]] = scan_result
+            print(f"Processed {scan_result['scan_path']}")
 
+    # Keep the discovery order of the sequential mode
+    results = [done[p] for p in scans if p in done]
+    df = _save_results(results, region_names, output_xlsx)
+    for row in results:
+        deps.put(row["scan_path"], signatures[row["scan_path"]], row)
+    deps.prune(signatures)
+    deps.save()
+    update_roi_stats(stats_path(output_xlsx), {r["scan_path"]: r for r in results}, previous, _group_of,
+                     region_names + COMPOSITE_REGIONS)
+    os.remove(checkpoint_path)
+    instrumentation.summarize()
     return df
 
 
 if __name__ == "__main__":
-    compute_averages('shoot/', 'aal116.json', 'shoot/correlations/ROI_correlations/aal_values.xlsx')
+    manifest_path = sys.argv[sys.argv.index("--manifest") + 1] if "--manifest" in sys.argv else None
+    incremental = "--force" not in sys.argv  # --force recomputes every scan
+    if "--profile" in sys.argv:
+        instrumentation.enable(sys.argv[sys.argv.index("--profile") + 1])
+    if "--parallel" in sys.argv:
+        compute_averages_parallel('shoot/', 'aal116.json', 'shoot/correlations/ROI_correlations/aal_values.xlsx',
+                                  n_workers=8, manifest=manifest_path, incremental=incremental)
+    else:
+        compute_averages('shoot/', 'aal116.json', 'shoot/correlations/ROI_correlations/aal_values.xlsx',
+                         manifest=manifest_path, incremental=incremental)
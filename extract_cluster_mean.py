@@ -1,68 +1,181 @@
 #!/usr/bin/env python3
-import sys
 import os
 import glob
+import fnmatch
+import argparse
 import numpy as np
-import nibabel as nib
-import pandas as pd
+from atlas_cache import load_atlas_index, flat_view
+from volume_cache import load_nifti, read_slab, nifti_stem
+from manifest import as_manifest
+from provenance import input_signature, RowCache, deps_path
+import instrumentation
+from instrumentation import stage
+from results_store import ResultsStore, DEFAULT_STORE, subject_key
+from virtual_images import parse_name, resolve
 
-def extract_means(search_pattern, search_dir, output_excel):
-    mask_img = nib.load("multreg_cluster.nii")
-    mask = mask_img.get_fdata() > 0  # binary mask
+DEFAULT_MASK = "multreg_cluster.nii"
 
-    # Build search path
-    search_path = os.path.join(search_dir, f"**/{search_pattern}.nii*")
-    nii_files = glob.glob(search_path, recursive=True)
 
+def load_masks(masks=(DEFAULT_MASK,), label_image=None):
+    """(name, AtlasIndex, label) of every binary mask (> 0) and of every label of label_image."""
+    out = [(nifti_stem(m), load_atlas_index(m, threshold=0), None) for m in masks]
+    if label_image is not None:
+        index = load_atlas_index(label_image)
+        out += [(f"{nifti_stem(label_image)}_{int(label)}", index, int(label)) for label in index.labels if label > 0]
+    if not out:
+        raise ValueError("No masks given")
+    if len({index.shape for _, index, _ in out}) > 1:
+        raise ValueError("All masks must share one grid: " + ", ".join(f"{n} {i.shape}" for n, i, _ in out))
+    return out
+
+
+def find_images(search_patterns, search_dir, manifest=None, virtual=False):
+    """Every image whose name matches one of the patterns, from a single walk of search_dir.
+
+    With virtual, a normalized name without wildcards (e.g. hn_wr_petsuv)
+    also yields the path it would have next to each of its source images,
+    for subjects where it was never materialized.
+    """
+    globs = [f"{p}.nii*" for p in search_patterns]
+    if manifest is not None:
+        files = [p for p, _, _ in as_manifest(manifest).files(under=search_dir)]
+    else:
+        files = [os.path.join(d, f) for d, _, names in os.walk(search_dir) for f in names]
+    found = [f for f in files if any(fnmatch.fnmatch(os.path.basename(f), g) for g in globs)]
+    if virtual:
+        sources = {}
+        for p in search_patterns:
+            if parse_name(p) and not glob.has_magic(p):
+                sources.setdefault(parse_name(p)[1], []).append(p)
+        existing = {os.path.join(os.path.dirname(f), nifti_stem(f)) for f in found}
+        for f in files:
+            for name in (sources.get(nifti_stem(f), []) if f.endswith((".nii", ".nii.gz")) else []):
+                if os.path.join(os.path.dirname(f), name) not in existing:
+                    found.append(os.path.join(os.path.dirname(f), name + ".nii"))
+    return found
+
+
+def extract_means(search_patterns, search_dir, output_excel=None, store_path=DEFAULT_STORE, table="cluster_means",
+                  manifest=None, incremental=True, masks=(DEFAULT_MASK,), label_image=None, factors_store=None):
+    """Mean of each matched image under every mask, upserted into the results store.
+
+    search_patterns is one file name pattern or a list of them (shell
+    wildcards allowed, e.g. ihn*_wr_petsuv); each image is read once, as the
+    union bounding box of the masks, for all of its (image, mask) means. The
+    column is the image's file name, or <name>__<mask> when there is more than
+    one mask; masks are binary files (> 0) and/or the labels of label_image.
+    Excel is only written when output_excel is given. With incremental,
+    images unchanged since the last run (same file stats and mask) reuse
+    their mean from <store>.deps.json instead of being read again.
+    With factors_store, normalized images that were never written (e.g.
+    hn_wr_petsuv) are read as wr_petsuv / the factor stored there.
+    """
+    if isinstance(search_patterns, str):
+        search_patterns = [search_patterns]
+    masks = load_masks(masks, label_image)
+    shape = masks[0][1].shape
+    # Only the bounding box enclosing every mask is read from each image
+    boxes = [index.bbox(label) for _, index, label in masks]
+    boxes = [b for b in boxes if b is not None]
+    bbox = tuple(slice(min(b[i].start for b in boxes), max(b[i].stop for b in boxes)) for i in range(3)) \
+        if boxes else None
+    slab_voxels = [index.slab_voxels(label, bbox)[1] for _, index, label in masks]
+
+    nii_files = find_images(search_patterns, search_dir, manifest, virtual=factors_store is not None)
     if not nii_files:
-        print(f"No files found in {search_dir} with pattern '{search_pattern}'")
+        print(f"No files found in {search_dir} with pattern(s) {', '.join(search_patterns)}")
         return
 
+    deps = RowCache(deps_path(store_path))
+    columns = set()
+    current = set()
     results = []
 
     for f in nii_files:
+        stem = nifti_stem(f)
+        img, inputs, factor = None, [f], None
+        if factors_store is not None and not os.path.exists(f):
+            try:
+                img = resolve(f, factors_store)
+            except (KeyError, FileNotFoundError) as e:
+                print(f"Warning: {e} → skipping")
+                continue
+            inputs, factor = [img.source_path], img.factor
+        cells = []
+        for name, index, label in masks:
+            column = stem if len(masks) == 1 else f"{stem}__{name}"
+            key = f"{table}|{column}|{os.path.abspath(f)}"
+            cells.append((column, key, input_signature(inputs, mask=index.key, label=label, factor=factor)))
+            columns.add(column)
+            current.add(key)
+        cached = [deps.get(key, sig) if incremental else None for _, key, sig in cells]
+        if all(v is not None for v in cached):
+            results.extend((*subject_key(f), column, v) for (column, _, _), v in zip(cells, cached))
+            continue
         try:
-            img = nib.load(f)
-            data = img.get_fdata()
+            img = img or load_nifti(f)
 
-            # Check shape compatibility
-            if data.shape != mask.shape:
-                print(f"Warning: {f} has shape {data.shape}, mask has shape {mask.shape} → skipping")
+            # Check shape compatibility (header only)
+            if img.shape != shape:
+                print(f"Warning: {f} has shape {img.shape}, mask has shape {shape} → skipping")
                 continue
 
-            values = data[mask]
-            mean_val = float(np.mean(values)) if values.size > 0 else np.nan
+            if bbox is not None:
+                with stage(f, "load"):
+                    slab = flat_view(read_slab(img, bbox))
+            with stage(f, "reduce"):
+                means = [float(slab[idx].mean(dtype=np.float64)) if idx.size > 0 else np.nan for idx in slab_voxels]
 
-            results.append({"file": os.path.dirname(f), "mean": mean_val})
-            print(f"Processed {f} → mean = {mean_val:.4f}")
+            for (column, key, signature), mean_val in zip(cells, means):
+                results.append((*subject_key(f), column, mean_val))
+                deps.put(key, signature, mean_val)
+            print(f"Processed {f} → mean = {', '.join(f'{m:.4f}' for m in means)}")
         except Exception as e:
             print(f"Error with {f}: {e}")
 
+    # Forget images of these columns that are gone; other tables/columns share the file
+    prefixes = tuple(f"{table}|{c}|" for c in columns)
+    deps.prune([k for k in deps.entries if not k.startswith(prefixes)] + list(current))
+
     if not results:
+        deps.save()
         print("No valid results to save.")
         return
 
-    # Convert to DataFrame
-    df_new = pd.DataFrame(results)
-
-    # If file exists → append
-    if os.path.exists(output_excel):
-        df_old = pd.read_excel(output_excel)
-        df = pd.concat([df_old, df_new], ignore_index=True)
-    else:
-        df = df_new
-
-    # Save to Excel
-    df.to_excel(output_excel, index=False)
-    print(f"Results saved to {output_excel}")
+    # Upsert into the store; concurrent jobs only touch their own cells
+    with ResultsStore(store_path) as store:
+        with stage("run", "store"):
+            store.upsert(table, results)
+        # Sidecar last, so a failed save never loses the results already in the store
+        deps.save()
+        print(f"Results saved to {store_path} (table '{table}')")
+        instrumentation.summarize()
+        if output_excel:
+            return store.export_excel(table, output_excel)
+        return store.frame(table)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: python extract_means.py <search_name> <directory> <output.xlsx>")
-        sys.exit(1)
-
-    search_name = sys.argv[1]
-    search_dir = sys.argv[2]
-    output_excel = sys.argv[3]
+    parser = argparse.ArgumentParser(description="Mean PET value under one or more cluster masks for every matched image.")
+    parser.add_argument("search_name", help="file name without extension, e.g. wr_petsuv; several comma-separated "
+                                            "names or wildcards (wr_petsuv,ihn*_wr_petsuv) are read in one pass")
+    parser.add_argument("directory")
+    parser.add_argument("output_excel", nargs="?", default=None, help="optional Excel export of the table")
+    parser.add_argument("--store", default=DEFAULT_STORE)
+    parser.add_argument("--table", default="cluster_means")
+    parser.add_argument("--manifest", default=None, help="saved manifest to look files up in instead of globbing")
+    parser.add_argument("--force", action="store_true", help="re-read every image, even if unchanged")
+    parser.add_argument("--mask", action="append", default=None,
+                        help=f"binary mask (> 0), repeatable (default {DEFAULT_MASK})")
+    parser.add_argument("--label-image", default=None, help="multi-label cluster image, one mask per label")
+    parser.add_argument("--factors-store", default=None,
+                        help="results store with normalizing_factors; normalized images missing on disk "
+                             "(hn_wr_petsuv, pons_wr_petsuv, ...) are then computed on read")
+    parser.add_argument("--profile", default=None, help="write per-image stage timings to this JSON-lines file")
+    args = parser.parse_args()
+    if args.profile:
+        instrumentation.enable(args.profile)
 
-    extract_means(search_name, search_dir, output_excel)
+    masks = args.mask if args.mask is not None else ([] if args.label_image else [DEFAULT_MASK])
+    extract_means(args.search_name.split(","), args.directory, args.output_excel, args.store, args.table,
+                  args.manifest, incremental=not args.force, masks=masks, label_image=args.label_image,
+                  factors_store=args.factors_store)
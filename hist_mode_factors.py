@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+import os
+import argparse
+import numpy as np
+from atlas_cache import load_atlas_index, flat_view
+from volume_cache import load_nifti
+from results_store import ResultsStore, DEFAULT_STORE, subject_key
+
+NBINS = 1000
+
+
+def histogram_modes(values, rows, n_rows, nbins=NBINS):
+    """Histogram mode of each row's values, for all rows in one bincount.
+
+    Each row gets nbins equal-width bins spanning its own min..max (last bin
+    closed on the right, like histcounts) and the mode is the centre of the
+    fullest bin, (edges(idx) + edges(idx+1)) / 2. Rows without values are NaN.
+    """
+    vmin = np.full(n_rows, np.inf)
+    vmax = np.full(n_rows, -np.inf)
+    np.minimum.at(vmin, rows, values)
+    np.maximum.at(vmax, rows, values)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        width = (vmax - vmin) / nbins
+        bins = np.floor((values - vmin[rows]) / width[rows])
+    bins = np.clip(np.nan_to_num(bins), 0, nbins - 1).astype(np.intp)
+
+    counts = np.bincount(rows * nbins + bins, minlength=n_rows * nbins).reshape(n_rows, nbins)
+    idx = np.argmax(counts, axis=1)
+    with np.errstate(invalid="ignore"):
+        modes = vmin + (idx + 0.5) * width
+    modes[counts.sum(axis=1) == 0] = np.nan
+    return modes
+
+
+def masked_ratio(pet_path, template_flat, voxels):
+    """Finite values of pet / template under the mask voxels."""
+    pet = flat_view(np.asanyarray(load_nifti(pet_path).dataobj))[voxels].astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vals = pet / template_flat[voxels]
+    return vals[np.isfinite(vals)]
+
+
+def cohort_modes(pet_paths, template_path, mask_for, block_size=64):
+    """Histogram modes of pet / template for a cohort, a block of subjects at a time.
+
+    mask_for(pet_path) returns the flat mask voxel indices of that subject.
+    """
+    template_flat = flat_view(load_nifti(template_path).get_fdata())
+    modes = np.full(len(pet_paths), np.nan)
+
+    for start in range(0, len(pet_paths), block_size):
+        block = pet_paths[start:start + block_size]
+        values, rows = [], []
+        for i, pet_path in enumerate(block):
+            vals = masked_ratio(pet_path, template_flat, mask_for(pet_path))
+            values.append(vals)
+            rows.append(np.full(len(vals), i, dtype=np.intp))
+        modes[start:start + len(block)] = histogram_modes(np.concatenate(values), np.concatenate(rows), len(block))
+
+    for pet_path, mode_val in zip(pet_paths, modes):
+        print(f"Mode of {pet_path}: {mode_val:.4f}")
+    return modes
+
+
+def store_factors(store_path, pet_paths, column, values, excel_file=None):
+    """Upsert one factor column into the normalizing_factors table of the results store."""
+    with ResultsStore(store_path) as store:
+        store.upsert("normalizing_factors",
+                     [(*subject_key(p), column, v) for p, v in zip(pet_paths, values)])
+        print(f"✅ Normalization factors updated in: {store_path}")
+        if excel_file:
+            return store.export_excel("normalizing_factors", excel_file)
+        return store.frame("normalizing_factors")
+
+
+def find_scans(directory, name="s_wr_petsuv.nii"):
+    scans = []
+    for dirpath, _, filenames in os.walk(directory):
+        if name in filenames:
+            scans.append(os.path.join(dirpath, name))
+    return sorted(scans)
+
+
+def threshold_suffix(threshold):
+    """Same string as strrep(num2str(threshold, '%.15g'), '.', '') in MATLAB."""
+    return format(threshold, ".15g").replace(".", "")
+
+
+def hn_factors(directory, template_path="hn_template.nii", mask_path="parenchymal_mask.nii", block_size=64,
+               store_path=None, excel_file=None):
+    """hn factors (inorm_hn.m) for every s_wr_petsuv.nii under directory."""
+    pet_paths = find_scans(directory)
+    voxels = load_atlas_index(mask_path, threshold=0).mask_voxels()
+    modes = cohort_modes(pet_paths, template_path, lambda p: voxels, block_size)
+    store_path = store_path or os.path.join(directory, DEFAULT_STORE)
+    return store_factors(store_path, pet_paths, "hn", modes, excel_file)
+
+
+def ihn_factors(patient_dir, threshold=0.01, template_path="hn_template.nii", block_size=64,
+                store_path=None, excel_file=None):
+    """ihn_<thr> factors (inorm_ihn.m), using each subject's ihn_mask<thr>.nii."""
+    patient_dir = patient_dir.rstrip("/")
+    threshold_str = threshold_suffix(threshold)
+
+    pet_paths = []
+    for pet_path in find_scans(patient_dir):
+        mask_path = os.path.join(os.path.dirname(pet_path), f"ihn_mask{threshold_str}.nii")
+        if not os.path.exists(mask_path):
+            print(f"Mask not found: {mask_path}. Skipping.")
+            continue
+        pet_paths.append(pet_path)
+
+    def subject_mask(pet_path):
+        mask_path = os.path.join(os.path.dirname(pet_path), f"ihn_mask{threshold_str}.nii")
+        return load_atlas_index(mask_path, threshold=0.5).mask_voxels()
+
+    modes = cohort_modes(pet_paths, template_path, subject_mask, block_size)
+    store_path = store_path or os.path.join(os.path.dirname(patient_dir), DEFAULT_STORE)
+    return store_factors(store_path, pet_paths, f"ihn_{threshold_str}", modes, excel_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batched histogram-mode (hn / ihn) normalizing factors.")
+    sub = parser.add_subparsers(dest="method", required=True)
+    p_hn = sub.add_parser("hn")
+    p_hn.add_argument("directory")
+    p_ihn = sub.add_parser("ihn")
+    p_ihn.add_argument("patient_dir")
+    p_ihn.add_argument("threshold", nargs="?", type=float, default=0.01)
+    for p in (p_hn, p_ihn):
+        p.add_argument("--template", default="hn_template.nii")
+        p.add_argument("--block-size", type=int, default=64)
+        p.add_argument("--store", default=None, help=f"results store (default: <cohort dir>/{DEFAULT_STORE})")
+        p.add_argument("--excel", default=None, help="also export normalizing_factors to this workbook")
+    p_hn.add_argument("--mask", default="parenchymal_mask.nii")
+    args = parser.parse_args()
+
+    if args.method == "hn":
+        hn_factors(args.directory, args.template, args.mask, args.block_size, args.store, args.excel)
+    else:
+        ihn_factors(args.patient_dir, args.threshold, args.template, args.block_size, args.store, args.excel)
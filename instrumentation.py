@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager
+import pandas as pd
+
+# Path of the JSON-lines log; profiling is off unless it is set. Kept in the
+# environment so process-pool workers inherit it.
+ENV_VAR = "PET_PROFILE_LOG"
+
+# Pseudo-subject of whole-run stages (Excel/store writes), left out of the per-subject summary
+RUN_SUBJECT = "run"
+
+
+def enable(path, truncate=True):
+    """Turn on per-subject, per-stage profiling for this process and the workers it starts."""
+    if truncate and os.path.exists(path):
+        os.remove(path)
+    os.environ[ENV_VAR] = os.path.abspath(path)
+    return path
+
+
+def enabled():
+    return bool(os.environ.get(ENV_VAR))
+
+
+def _io_counters():
+    """(rchar, read_bytes) of this process: bytes read through syscalls and from the block device."""
+    try:
+        with open("/proc/self/io", "r") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["read_bytes"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _rss_high_water_mb():
+    """Process-lifetime peak RSS (ru_maxrss): the largest footprint so far, not that of the current stage."""
+    to_mb = 1 / (1024 * 1024) if sys.platform == "darwin" else 1 / 1024  # bytes on macOS, KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * to_mb
+
+
+@contextmanager
+def stage(subject, name):
+    """Time one stage of one subject and append it to the log (no-op when profiling is off).
+
+    Stages that belong to the whole run rather than a subject use subject RUN_SUBJECT.
+    """
+    path = os.environ.get(ENV_VAR)
+    if not path:
+        yield
+        return
+    rchar, read_bytes = _io_counters()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - start
+        rchar_end, read_bytes_end = _io_counters()
+        record = {
+            "subject": str(subject), "stage": name, "wall_s": wall,
+            "rchar": rchar_end - rchar, "read_bytes": read_bytes_end - read_bytes,
+            "rss_high_water_mb": _rss_high_water_mb(), "pid": os.getpid(), "time": time.time(),
+        }
+        # One short O_APPEND write per record, so concurrent workers don't interleave lines
+        with open(path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+def load_log(path=None):
+    path = path or os.environ.get(ENV_VAR)
+    records = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return pd.DataFrame(records)
+
+
+def summarize(path=None, top=10):
+    """Print the slowest subjects and the per-stage totals of a profiling log."""
+    path = path or os.environ.get(ENV_VAR)
+    if not path or not os.path.exists(path):
+        return None
+    df = load_log(path)
+    if df.empty:
+        return None
+
+    stages = df.groupby("stage").agg(calls=("wall_s", "size"), total_s=("wall_s", "sum"), mean_s=("wall_s", "mean"),
+                                     max_s=("wall_s", "max"), read_mb=("rchar", lambda x: x.sum() / 2 ** 20),
+                                     rss_high_water_mb=("rss_high_water_mb", "max"))
+    per_subject = df[df["subject"] != RUN_SUBJECT]
+    subjects = per_subject.groupby("subject").agg(total_s=("wall_s", "sum"), worker=("pid", "first"))
+    slowest_stage = per_subject.loc[per_subject.groupby("subject")["wall_s"].idxmax(), ["subject", "stage"]]
+    subjects = subjects.join(slowest_stage.set_index("subject").rename(columns={"stage": "slowest_stage"}))
+
+    print(f"⏱️ Profile of {len(subjects)} subjects, {df['pid'].nunique()} processes ({path}); "
+          f"rss_high_water_mb is the process peak so far, not the stage's own")
+    print(stages.sort_values("total_s", ascending=False).to_string(float_format=lambda v: f"{v:.3f}"))
+    print(f"Slowest {min(top, len(subjects))} subjects:")
+    print(subjects.sort_values("total_s", ascending=False).head(top).to_string(float_format=lambda v: f"{v:.3f}"))
+    return stages, subjects
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python instrumentation.py <profile.jsonl> [top]")
+        sys.exit(1)
+    summarize(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 10)
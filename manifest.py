@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import os
+import json
+import uuid
+import fnmatch
+import argparse
+
+# Sub-folders whose files belong to the subject folder above them (CAT12/SPM outputs)
+SUBJECT_SUBDIRS = {"mri", "label", "report", "surf"}
+NIFTI_EXTENSIONS = (".nii", ".nii.gz")
+
+
+def _scan_dir(path):
+    """One scandir of a folder: (mtime_ns, {file: [size, mtime_ns]}, [sub-folder names])."""
+    files, subdirs = {}, []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                st = entry.stat()
+                files[entry.name] = [st.st_size, st.st_mtime_ns]
+    return os.stat(path).st_mtime_ns, files, subdirs
+
+
+class Manifest:
+    """Cached listing of a cohort tree laid out as <group>/<IPP>/<date>/.
+
+    Each folder is stored with its mtime and file stats, so refresh() only
+    re-lists folders whose mtime changed (files added, removed or renamed).
+    Files rewritten in place keep their recorded stats until their folder
+    changes or refresh(stat_files=True) is used.
+    """
+
+    def __init__(self, root, dirs=None):
+        self.root = root
+        self.dirs = dirs or {}  # relative folder → {"mtime": ns, "files": {...}, "subdirs": [...]}
+
+    def _scan(self, rel):
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            mtime, files, subdirs = _scan_dir(os.path.join(self.root, rel))
+            self.dirs[rel] = {"mtime": mtime, "files": files, "subdirs": sorted(subdirs)}
+            stack.extend(os.path.join(rel, d) if rel else d for d in subdirs)
+
+    def _drop(self, rel):
+        prefix = rel + os.sep
+        for key in [k for k in self.dirs if k == rel or k.startswith(prefix)]:
+            del self.dirs[key]
+
+    def scan(self):
+        """Full scan of the tree."""
+        self.dirs = {}
+        self._scan("")
+        return self
+
+    def refresh(self, stat_files=False):
+        """Re-list only the folders whose mtime changed; returns the number re-listed."""
+        changed = 0
+        for rel in sorted(self.dirs):
+            if rel not in self.dirs:
+                continue  # dropped with a removed parent
+            path = os.path.join(self.root, rel)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                self._drop(rel)
+                changed += 1
+                continue
+            entry = self.dirs[rel]
+            if mtime != entry["mtime"]:
+                _, files, subdirs = _scan_dir(path)
+                entry.update(mtime=mtime, files=files)
+                for gone in set(entry["subdirs"]) - set(subdirs):
+                    self._drop(os.path.join(rel, gone) if rel else gone)
+                for new in set(subdirs) - set(entry["subdirs"]):
+                    self._scan(os.path.join(rel, new) if rel else new)
+                entry["subdirs"] = sorted(subdirs)
+                changed += 1
+            elif stat_files:
+                for name, stat in entry["files"].items():
+                    st = os.stat(os.path.join(path, name))
+                    stat[:] = [st.st_size, st.st_mtime_ns]
+        return changed
+
+    def files(self, under=None):
+        """(path, size, mtime_ns) of every file, optionally restricted to a sub-folder.
+
+        Paths under a sub-folder are spelled relative to it, as os.walk(under) would.
+        """
+        prefix = os.path.abspath(under) + os.sep if under else None
+        for rel in sorted(self.dirs):
+            folder = os.path.join(self.root, rel) if rel else self.root
+            for name, (size, mtime) in sorted(self.dirs[rel]["files"].items()):
+                path = os.path.join(folder, name)
+                if prefix is None:
+                    yield path, size, mtime
+                elif os.path.abspath(path).startswith(prefix):
+                    yield os.path.join(under, os.path.abspath(path)[len(prefix):]), size, mtime
+
+    def find(self, name, under=None):
+        """All files with a given name (like find_files in calculate_rois)."""
+        return [p for p, _, _ in self.files(under) if os.path.basename(p) == name]
+
+    def glob(self, pattern, under=None):
+        """All files whose name matches a shell pattern."""
+        return [p for p, _, _ in self.files(under) if fnmatch.fnmatch(os.path.basename(p), pattern)]
+
+    def subjects(self):
+        """One record per subject folder: group, IPP, date and its files (incl. mri/ etc.)."""
+        subjects = {}
+        for rel in sorted(self.dirs):
+            parts = rel.split(os.sep) if rel else []
+            in_subdir = bool(parts) and parts[-1] in SUBJECT_SUBDIRS
+            files = self.dirs[rel]["files"]
+            if not in_subdir and not any(n.endswith(NIFTI_EXTENSIONS) for n in files):
+                continue
+            owner = os.sep.join(parts[:-1] if in_subdir else parts)
+            subject_dir = os.path.abspath(os.path.join(self.root, owner))
+            record = subjects.setdefault(owner, {
+                "dir": os.path.join(self.root, owner) if owner else self.root,
+                "group": os.path.basename(os.path.dirname(os.path.dirname(subject_dir))),
+                "ipp": os.path.basename(os.path.dirname(subject_dir)),
+                "date": os.path.basename(subject_dir),
+                "files": {},
+            })
+            sub = parts[-1] if in_subdir else None
+            for name, stat in files.items():
+                record["files"][os.path.join(sub, name) if sub else name] = stat
+        return list(subjects.values())
+
+    def save(self, path):
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"root": self.root, "dirs": self.dirs, "subjects": self.subjects()}, f)
+        os.replace(tmp, path)
+
+
+def build_manifest(root, path=None):
+    """Scan a cohort tree once and optionally save the manifest."""
+    manifest = Manifest(root).scan()
+    if path:
+        manifest.save(path)
+        print(f"Manifest of {len(manifest.dirs)} folders saved to {path}")
+    return manifest
+
+
+def load_manifest(path, refresh=True):
+    """Load a saved manifest, bringing it up to date incrementally."""
+    with open(path, "r") as f:
+        data = json.load(f)
+    manifest = Manifest(data["root"], data["dirs"])
+    if refresh and manifest.refresh():
+        manifest.save(path)
+    return manifest
+
+
+def as_manifest(manifest):
+    """Accept either a Manifest or the path of a saved one."""
+    if manifest is None or isinstance(manifest, Manifest):
+        return manifest
+    return load_manifest(manifest)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or refresh the subject manifest of a cohort tree.")
+    parser.add_argument("root")
+    parser.add_argument("--output", default=None, help="manifest file (default: <root>/manifest.json)")
+    parser.add_argument("--full", action="store_true", help="rescan everything instead of refreshing")
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(args.root, "manifest.json")
+    if os.path.exists(output) and not args.full:
+        m = load_manifest(output)
+        print(f"Manifest {output} refreshed ({len(m.subjects())} subjects)")
+    else:
+        m = build_manifest(args.root, output)
+        print(f"{len(m.subjects())} subjects")
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+import os
+import glob
+import argparse
+import nibabel as nib
+import numpy as np
+from scipy.ndimage import binary_erosion, generate_binary_structure
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from atlas_cache import load_atlas_index
+
+USAGE_OPS = """operations, applied in order:
+  binarize:N[:THR]   union of (volume > THR) over the first N volumes (default THR 0.1), must come first
+  erode[:ITER]       binary erosion with a 6-connected element, ITER times (default 1)
+  intersect:MASK     keep voxels where MASK > 0
+A pipeline not starting with binarize starts from the input > 0."""
+
+
+def parse_ops(specs):
+    """Turn 'name:arg:arg' strings into (name, args) tuples."""
+    ops = []
+    for i, spec in enumerate(specs):
+        name, *args = spec.split(":")
+        if name == "binarize":
+            if i != 0:
+                raise ValueError("binarize must be the first operation")
+            ops.append((name, (int(args[0]), float(args[1]) if len(args) > 1 else 0.1)))
+        elif name == "erode":
+            ops.append((name, (int(args[0]) if args else 1,)))
+        elif name == "intersect":
+            ops.append((name, (args[0],)))
+        else:
+            raise ValueError(f"Unknown operation: {spec}")
+    return ops
+
+
+def initial_mask(img, ops):
+    """Boolean mask the pipeline starts from, read volume by volume in the stored dtype."""
+    if ops and ops[0][0] == "binarize":
+        n_volumes, threshold = ops[0][1]
+        if n_volumes > 1 and (len(img.shape) != 4 or img.shape[3] < n_volumes):
+            raise ValueError(f"Input must be a 4D file with at least {n_volumes} volumes")
+        mask = np.zeros(img.shape[:3], dtype=bool)
+        for i in range(n_volumes):
+            volume = img.dataobj[..., i] if len(img.shape) == 4 else img.dataobj[...]
+            mask |= np.asarray(volume) > threshold
+        return mask, ops[1:]
+    volume = img.dataobj[..., 0] if len(img.shape) == 4 else img.dataobj[...]
+    return np.asarray(volume) > 0, ops
+
+
+def bounding_box(mask, margin):
+    """Slices of the mask's bounding box grown by margin voxels (clipped to the volume)."""
+    coords = [np.flatnonzero(np.any(mask, axis=tuple(a for a in range(3) if a != axis))) for axis in range(3)]
+    if any(len(c) == 0 for c in coords):
+        return None
+    return tuple(slice(max(c[0] - margin, 0), min(c[-1] + margin + 1, n)) for c, n in zip(coords, mask.shape))
+
+
+def run_pipeline(input_file, output_file, ops):
+    """Apply the operations to one mask inside its bounding box and write it as uint8."""
+    img = nib.load(input_file)
+    mask, ops = initial_mask(img, ops)
+
+    # Erosion needs its structuring-element margin of background around the mask
+    margin = max([args[0] for name, args in ops if name == "erode"], default=0)
+    box = bounding_box(mask, margin)
+    out = np.zeros(mask.shape, dtype=np.uint8)
+
+    if box is not None:
+        crop = mask[box]
+        struct = generate_binary_structure(3, 1)
+        for name, args in ops:
+            if name == "erode":
+                crop = binary_erosion(crop, structure=struct, iterations=args[0])
+            elif name == "intersect":
+                other = load_atlas_index(args[0], threshold=0)
+                if other.shape != mask.shape:
+                    raise ValueError(f"{args[0]} has shape {other.shape}, {input_file} has {mask.shape}")
+                crop &= other.mask()[box]
+        out[box] = crop
+
+    header = img.header.copy()
+    header.set_data_dtype(np.uint8)
+    nib.save(nib.Nifti1Image(out, img.affine, header), output_file)
+    return output_file
+
+
+def output_name(input_file, suffix, outdir=None):
+    for ext in (".nii.gz", ".nii"):
+        if input_file.endswith(ext):
+            stem, out_ext = input_file[:-len(ext)], ext
+            break
+    else:
+        stem, out_ext = input_file, ".nii"
+    if outdir:
+        stem = os.path.join(outdir, os.path.basename(stem))
+    return stem + suffix + out_ext
+
+
+def expand_inputs(patterns):
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        files.extend(matches if matches else [pattern])
+    return files
+
+
+def batch_mask_ops(inputs, op_specs, suffix="_mask", outdir=None, n_workers=4):
+    """Run the same mask pipeline over many files on a worker pool."""
+    ops = parse_ops(op_specs)
+    files = expand_inputs(inputs)
+    if outdir:
+        os.makedirs(outdir, exist_ok=True)
+
+    outputs = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(run_pipeline, f, output_name(f, suffix, outdir), ops): f for f in files}
+        for future in as_completed(futures):
+            try:
+                outputs.append(future.result())
+                print(f"Mask saved to {outputs[-1]}")
+            except Exception as e:
+                print(f"Error with {futures[future]}: {e}")
+    return outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch binarize / erode / intersect masks.",
+                                     epilog=USAGE_OPS, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="input files or glob patterns (quote them, ** allowed)")
+    parser.add_argument("--op", dest="ops", action="append", required=True, help="operation, repeatable")
+    parser.add_argument("--suffix", default="_mask")
+    parser.add_argument("--outdir", default=None)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    batch_mask_ops(args.inputs, args.ops, args.suffix, args.outdir, args.workers)
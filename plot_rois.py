@@ -1,54 +1,43 @@
-import matplotlib.pyplot as plt
 import pandas as pd
 import os
+from render_service import render_all
+from excel_cache import CachedWorkbook
 
 def extract_region_values(excel_path, region):
-    file = pd.ExcelFile(excel_path)
+    # Column → sheet lookups come from the cached index, only the found column is read
+    file = CachedWorkbook(excel_path)
     fallback_region = "rGM" if region.startswith("rindividual_mask") else None
 
     # First try to find the exact region in any sheet
-    for sheet_name in file.sheet_names:
-        df = file.parse(sheet_name)
-        if region in df.columns:
-            return df[region].dropna()
+    values = file.read_column(region)
+    if values is not None:
+        return values.dropna()
 
     # If not found, try fallback if applicable
     if fallback_region:
-        for sheet_name in file.sheet_names:
-            df = file.parse(sheet_name)
-            if fallback_region in df.columns:
-                print(f"⚠️ '{region}' not found in '{excel_path}'. Falling back to '{fallback_region}' in sheet '{sheet_name}'.")
-                return df[fallback_region].dropna()
+        sheet_name = file.find_column(fallback_region)
+        if sheet_name is not None:
+            print(f"⚠️ '{region}' not found in '{excel_path}'. Falling back to '{fallback_region}' in sheet '{sheet_name}'.")
+            return file.read(sheet_name, [fallback_region])[fallback_region].dropna()
 
     print(f"❌ Neither '{region}' nor fallback found in any sheet of '{excel_path}'.")
     return pd.Series(dtype=float)
 
-def plot_region_histogram(excel_files, region, unit, save_path):
-    plt.figure(figsize=(10, 6))
-
+def region_histogram_spec(excel_files, region, unit, save_path):
+    series = []
     for excel_path in excel_files:
         values = extract_region_values(excel_path, region)
         if values.empty:
             continue
 
         label = excel_path.split("/")[-1].split(".")[0]  # Filename as label
-        mean_value = values.mean()
+        series.append((label, values.to_numpy()))
 
-        _, _, patches = plt.hist(values, bins=25, alpha=0.5, label=f"{label} (mean={mean_value:.2f})")
-        color = patches[0].get_facecolor()
-        plt.axvline(mean_value, linestyle='dashed', linewidth=1.5, color=color)
+    return {"kind": "histogram", "path": save_path, "figsize": (10, 6), "series": series,
+            "bins": 25, "title": f"{region}", "xlabel": f"{unit}"}
 
-    plt.title(f"{region}", fontweight='bold')
-    plt.xlabel(f"{unit}")
-    plt.ylabel("Frequency")
-    plt.grid(True)
-    plt.legend()
-    plt.tight_layout()
-    ax = plt.gca()
-    ax.spines['top'].set_visible(False)
-    ax.spines['right'].set_visible(False)
-    plt.savefig(save_path, dpi=300)
-    plt.show()
+def plot_region_histogram(excel_files, region, unit, save_path):
+    return render_all([region_histogram_spec(excel_files, region, unit, save_path)])
 
 def main():
     # === USER SETTINGS ===
@@ -0,0 +1,68 @@
+import os
+import json
+import uuid
+import hashlib
+from atlas_cache import file_hash
+
+
+def input_signature(paths, content=False, **params):
+    """Digest of the input files (path, size, mtime or content hash) and the parameters.
+
+    Missing files are part of the signature, so a row computed while an
+    input was absent is redone once it appears.
+    """
+    inputs = []
+    for path in paths:
+        path = os.path.abspath(str(path))
+        if not os.path.exists(path):
+            inputs.append([path, None])
+        elif content:
+            inputs.append([path, file_hash(path)])
+        else:
+            st = os.stat(path)
+            inputs.append([path, st.st_size, st.st_mtime_ns])
+    payload = json.dumps({"inputs": inputs, "params": params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class RowCache:
+    """Sidecar JSON of per-subject output rows and the input signature each was computed from.
+
+    A rerun looks every subject up with its current signature and only
+    recomputes the misses; rows of subjects no longer present are pruned.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self.entries = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                print(f"Ignoring unreadable dependency file {path}")
+
+    def get(self, key, signature):
+        """Cached row of key if it was computed from the same inputs, else None."""
+        entry = self.entries.get(key)
+        if entry is None or entry["signature"] != signature:
+            return None
+        return entry["row"]
+
+    def put(self, key, signature, row):
+        self.entries[key] = {"signature": signature, "row": row}
+
+    def prune(self, keys):
+        keys = set(keys)
+        for key in [k for k in self.entries if k not in keys]:
+            del self.entries[key]
+
+    def save(self):
+        tmp = f"{self.path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+
+def deps_path(output_path):
+    return str(output_path) + ".deps.json"
@@ -1,48 +1,139 @@
 import os
-import sys
+import gzip
+import shutil
+import argparse
 import nibabel as nib
 import numpy as np
 from scipy.ndimage import center_of_mass
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from volume_cache import load_nifti
+import instrumentation
+from instrumentation import stage
 
-def realign_nii_files(root_dir, overwrite=False):
+def output_path(fpath, overwrite):
+    if overwrite:
+        return fpath
+    if fpath.endswith(".nii.gz"):
+        return fpath[:-7] + "_realigned.nii.gz"
+    elif fpath.endswith(".nii"):
+        return fpath[:-4] + "_realigned.nii"
+    return fpath + "_realigned"
+
+def streamed_center_of_mass(dataobj, slab=16):
+    """Voxel centre of mass of the first 3 axes, reading slabs of slices from the array proxy.
+
+    Slabs are read in their stored dtype and only the per-axis marginal sums
+    are accumulated (in float64), so memory stays at one slab.
+    """
+    shape = dataobj.shape[:3]
+    marginals = [np.zeros(n) for n in shape]
+    for z0 in range(0, shape[2], slab):
+        block = np.asarray(dataobj[:, :, z0:z0 + slab])
+        if block.ndim > 3:
+            block = block.reshape(block.shape[:3] + (-1,)).sum(axis=3, dtype=np.float64)
+        marginals[0] += block.sum(axis=(1, 2), dtype=np.float64)
+        marginals[1] += block.sum(axis=(0, 2), dtype=np.float64)
+        marginals[2][z0:z0 + block.shape[2]] = block.sum(axis=(0, 1), dtype=np.float64)
+    total = marginals[2].sum()
+    return np.array([(np.arange(len(m)) * m).sum() / total for m in marginals])
+
+def read_raw_header(fpath):
+    """On-disk header of a NIfTI-1/2 file (nib.load hands back a header with scaling reset)."""
+    with nib.openers.ImageOpener(fpath) as f:
+        block = f.read(nib.Nifti2Header.template_dtype.itemsize)
+    size = nib.Nifti1Header.template_dtype.itemsize
+    if nib.Nifti1Header.may_contain_header(block[:size]):
+        return nib.Nifti1Header(block[:size])
+    return nib.Nifti2Header(block)
+
+def realigned_header(header, new_affine):
+    """Copy of header with the affine set the way nibabel does when saving a new image."""
+    hdr = header.copy()
+    hdr.set_sform(new_affine, code='aligned')
+    hdr.set_qform(new_affine, code='unknown')
+    return hdr
+
+def write_header(fpath, out_path, hdr):
+    """Replace only the header block; data and extensions are copied byte for byte."""
+    block = hdr.binaryblock
+    if out_path == fpath and not fpath.endswith(".gz"):
+        # In place: the header has a fixed size, so it can be overwritten directly
+        with open(fpath, "r+b") as f:
+            f.write(block)
+        return
+
+    src_open = gzip.open if fpath.endswith(".gz") else open
+    tmp = out_path + ".tmp"
+    if out_path.endswith(".gz"):
+        dst = gzip.open(tmp, "wb", compresslevel=nib.openers.Opener.default_compresslevel)
+    else:
+        dst = open(tmp, "wb")
+    with src_open(fpath, "rb") as src, dst:
+        src.seek(len(block))
+        dst.write(block)
+        shutil.copyfileobj(src, dst, length=1 << 20)
+    os.replace(tmp, out_path)
+
+def realign_file(fpath, overwrite=False, header_only=False):
+    """Shift the affine of one image so that its centre of mass is at (0, 0, 0)."""
+    print(f"Processing: {fpath}")
+    out_path = output_path(fpath, overwrite)
+
+    with stage(fpath, "center_of_mass"):
+        if header_only:
+            header = read_raw_header(fpath)
+            # Straight from the file proxy: the decompressed cache would hold a full copy of every input.
+            # keep_file_open reads the slabs forward through one gzip stream instead of reopening it per slab
+            com_vox = streamed_center_of_mass(nib.load(fpath, keep_file_open=True).dataobj)
+            affine = header.get_best_affine()
+        else:
+            img = load_nifti(fpath)
+            data = img.get_fdata()
+            # Compute center of mass in voxel coordinates
+            com_vox = np.array(center_of_mass(data))
+            affine = img.affine
+
+    # Convert voxel coordinates to world coordinates
+    com_world = nib.affines.apply_affine(affine, com_vox)
+
+    # Shift affine so that CoM is at (0,0,0)
+    new_affine = affine.copy()
+    new_affine[:3, 3] -= com_world
+
+    # Save result
+    with stage(fpath, "write"):
+        if header_only:
+            write_header(fpath, out_path, realigned_header(header, new_affine))
+        else:
+            nib.save(nib.Nifti1Image(data, new_affine, img.header), out_path)
+    print(f"Saved: {out_path}")
+    return out_path
+
+def realign_nii_files(root_dir, overwrite=False, header_only=False, n_workers=1):
+    files = []
     for dirpath, _, filenames in os.walk(root_dir):
         for fname in filenames:
             if fname.lower().endswith((".nii", ".nii.gz")):
-                fpath = os.path.join(dirpath, fname)
-                print(f"Processing: {fpath}")
-
-                img = nib.load(fpath)
-                data = img.get_fdata()
-
-                # Compute center of mass in voxel coordinates
-                com_vox = np.array(center_of_mass(data))
-                # Convert voxel coordinates to world coordinates
-                com_world = nib.affines.apply_affine(img.affine, com_vox)
-
-                # Shift affine so that CoM is at (0,0,0)
-                new_affine = img.affine.copy()
-                new_affine[:3, 3] -= com_world
-
-                # Save result
-                if overwrite:
-                    out_path = fpath
-                else:
-                    if fpath.endswith(".nii.gz"):
-                        out_path = fpath[:-7] + "_realigned.nii.gz"
-                    elif fpath.endswith(".nii"):
-                        out_path = fpath[:-4] + "_realigned.nii"
-                    else:
-                        out_path = fpath + "_realigned"
-
-                nib.save(nib.Nifti1Image(data, new_affine, img.header), out_path)
-                print(f"Saved: {out_path}")
+                files.append(os.path.join(dirpath, fname))
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python realign_nii.py /path/to/directory [--overwrite]")
-        sys.exit(1)
+    if n_workers <= 1:
+        return [realign_file(f, overwrite, header_only) for f in files]
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(realign_file, f, overwrite, header_only) for f in files]
+        return [future.result() for future in as_completed(futures)]
 
-    directory = sys.argv[1]
-    overwrite_flag = "--overwrite" in sys.argv
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move the world origin of every NIfTI under a directory to its centre of mass.")
+    parser.add_argument("directory")
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--header-only", action="store_true",
+                        help="stream the data in its stored dtype and rewrite only the header")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--profile", default=None, help="write per-file stage timings to this JSON-lines file")
+    args = parser.parse_args()
+    if args.profile:
+        instrumentation.enable(args.profile)
 
-    realign_nii_files(directory, overwrite=overwrite_flag)
+    realign_nii_files(args.directory, overwrite=args.overwrite, header_only=args.header_only, n_workers=args.workers)
+    instrumentation.summarize()
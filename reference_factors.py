@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+import os
+import argparse
+from functools import lru_cache
+import numpy as np
+from scipy.ndimage import binary_erosion
+from concurrent.futures import ProcessPoolExecutor
+from volume_cache import load_nifti
+from atlas_resample import resample_atlas
+from hist_mode_factors import histogram_modes, find_scans, NBINS
+from manifest import as_manifest
+from provenance import input_signature, RowCache, deps_path
+from results_store import ResultsStore, DEFAULT_STORE, subject_key
+import instrumentation
+from instrumentation import stage
+
+FACTOR_TABLE = "normalizing_factors"
+
+FACTORS = ["pons", "wm", "cerebellum", "ps", "hn"]
+
+# Reference images shared by every subject (paths relative to the working directory, as in inorm_*.m)
+REFERENCES = {
+    "pons_atlas": "wfu_pons.nii",
+    "cerebellum_atlas": "aal_cerebellum.nii",
+    "parenchymal_mask": "parenchymal_mask.nii",
+    "hn_template": "hn_template.nii",
+    "assembly_folder": "results_assembly",
+}
+
+
+@lru_cache(maxsize=None)
+def _reference(path):
+    """Float data of a shared reference image, read once per worker."""
+    return load_nifti(path).get_fdata()
+
+
+def _positive_mean(values):
+    """Mean of the finite, positive values (the pons and cerebellum factors)."""
+    values = values[np.isfinite(values) & (values > 0)]
+    return float(values.mean()) if values.size else np.nan
+
+
+def _nan_mean(values):
+    values = values[~np.isnan(values)]
+    return float(values.mean()) if values.size else np.nan
+
+
+def subject_paths(pet_path, references=REFERENCES, gm_map="wp1mri.nii", wm_map="wp2mri.nii"):
+    """Per-subject inputs next to a PET: WM and GM maps, smoothed PET and the mni_tissues assembly."""
+    folder = os.path.dirname(pet_path)
+    group, ipp, date = subject_key(pet_path)
+    return {
+        "wm": os.path.join(folder, "mri", wm_map),
+        "gm": os.path.join(folder, "mri", gm_map),
+        "smoothed": os.path.join(folder, "s_" + os.path.basename(pet_path)),
+        "assembly": os.path.join(references["assembly_folder"], f"mni_tissues_{group}_{ipp}_{date}.nii.gz"),
+    }
+
+
+def factor_signature(pet_path, factors=FACTORS, references=REFERENCES):
+    """Input signature of one subject's factors: its images, the shared references and the factor list."""
+    shared = [path for name, path in sorted(references.items()) if name != "assembly_folder"]
+    return input_signature([pet_path, *subject_paths(pet_path, references).values(), *shared],
+                           factors=sorted(factors))
+
+
+def subject_factors(pet_path, factors=FACTORS, references=REFERENCES, gm_map="wp1mri.nii", wm_map="wp2mri.nii"):
+    """Every reference-region factor of one subject, from a single read of its PET and tissue maps.
+
+    pons        mean PET > 0 in WM > 0.2 ∩ wfu_pons > 0.5      (inorm_pons.m)
+    wm          mean PET in WM > 0.7 eroded by a 3x3x3 cube      (inorm_wm.m)
+    cerebellum  mean PET > 0 in (GM > 0.3 | WM > 0.3) ∩ aal_cerebellum > 0.5 ∩ assembly labels 5/6
+                                                                 (inorm_cerebellum.m)
+    ps          mean PET in parenchymal_mask > 0.5               (inorm_ps.m)
+    hn          histogram mode of s_wr_petsuv / hn_template in parenchymal_mask > 0  (inorm_hn.m)
+    Factors whose inputs are missing are NaN. No normalized images are written.
+    """
+    paths = subject_paths(pet_path, references, gm_map, wm_map)
+    wm_path, gm_path = paths["wm"], paths["gm"]
+    row = {}
+
+    with stage(pet_path, "load"):
+        img = load_nifti(pet_path)
+        pet = img.get_fdata()
+        wm_img = load_nifti(wm_path) if os.path.exists(wm_path) else None
+        wm = wm_img.get_fdata() if wm_img is not None else None
+        gm = load_nifti(gm_path).get_fdata() if "cerebellum" in factors and os.path.exists(gm_path) else None
+
+    with stage(pet_path, "factors"):
+        if "pons" in factors:
+            if wm is None:
+                row["pons"] = np.nan
+            else:
+                pons = resample_atlas(references["pons_atlas"], wm.shape, wm_img.affine)
+                row["pons"] = _positive_mean(pet[(wm > 0.2) & (pons > 0.5)])
+
+        if "wm" in factors:
+            if wm is None:
+                row["wm"] = np.nan
+            else:
+                # imerode pads binary images with 1, hence border_value=1
+                mask = binary_erosion(wm > 0.7, structure=np.ones((3, 3, 3), dtype=bool), border_value=1)
+                row["wm"] = _nan_mean(pet[mask])
+
+        if "cerebellum" in factors:
+            assembly_path = paths["assembly"]
+            if wm is None or gm is None or not os.path.exists(assembly_path):
+                row["cerebellum"] = np.nan
+            else:
+                # Per-subject atlas: resampled in memory, a cache entry would never be reused
+                assembly = resample_atlas(assembly_path, pet.shape, img.affine, cache=False)
+                roi = (((gm > 0.3) | (wm > 0.3)) & (_reference(references["cerebellum_atlas"]) > 0.5)
+                       & np.isin(assembly, (5, 6)))
+                row["cerebellum"] = _positive_mean(pet[roi])
+
+        if "ps" in factors:
+            mean_val = _nan_mean(pet[_reference(references["parenchymal_mask"]) > 0.5])
+            row["ps"] = mean_val if mean_val != 0 else np.nan
+
+        if "hn" in factors:
+            smoothed_path = paths["smoothed"]
+            if not os.path.exists(smoothed_path):
+                row["hn"] = np.nan
+            else:
+                mask = _reference(references["parenchymal_mask"]) > 0
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    vals = load_nifti(smoothed_path).get_fdata()[mask] / _reference(references["hn_template"])[mask]
+                vals = vals[np.isfinite(vals)]
+                row["hn"] = float(histogram_modes(vals, np.zeros(len(vals), dtype=np.intp), 1, NBINS)[0])
+
+    return row
+
+
+def _subject_task(pet_path, factors, references):
+    try:
+        return pet_path, subject_factors(pet_path, factors, references), None
+    except Exception as e:
+        return pet_path, None, str(e)
+
+
+def compute_factors(directory, factors=FACTORS, references=REFERENCES, n_workers=4, store_path=None,
+                    excel_file=None, pet_name="wr_petsuv.nii", manifest=None, incremental=True):
+    """All reference factors for every subject under directory, one row each in normalizing_factors.
+
+    With incremental, subjects whose inputs are unchanged since the last run
+    (see <store>.deps.json) reuse their factors instead of being read again.
+    """
+    if manifest is not None:
+        pet_paths = sorted(as_manifest(manifest).find(pet_name, under=directory))
+    else:
+        pet_paths = find_scans(directory, pet_name)
+    if not pet_paths:
+        print(f"No {pet_name} found under {directory}")
+        return
+
+    store_path = store_path or os.path.join(directory, DEFAULT_STORE)
+    deps = RowCache(deps_path(store_path))
+    prefix = f"{FACTOR_TABLE}|"
+    keys = {p: prefix + os.path.abspath(p) for p in pet_paths}
+    signatures = {p: factor_signature(p, factors, references) for p in pet_paths}
+    done = {}
+    if incremental:
+        for p in pet_paths:
+            row = deps.get(keys[p], signatures[p])
+            if row is not None:
+                done[p] = row
+    todo = [p for p in pet_paths if p not in done]
+    print(f"📈 {len(factors)} normalizing factors: {len(done)} subjects unchanged, {len(todo)} to process "
+          f"on {n_workers} workers")
+
+    if n_workers > 1 and todo:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_subject_task, todo, [factors] * len(todo), [references] * len(todo)))
+    else:
+        results = [_subject_task(p, factors, references) for p in todo]
+
+    for pet_path, row, error in results:
+        if error is not None:
+            print(f"Error with {pet_path}: {error}")
+            continue
+        print(f"✅ Done {pet_path} → " + ", ".join(f"{k}={v:.3f}" for k, v in row.items()))
+        done[pet_path] = row
+        deps.put(keys[pet_path], signatures[pet_path], row)
+
+    # Forget subjects that are gone; other tables share the sidecar
+    deps.prune([k for k in deps.entries if not k.startswith(prefix)] + list(keys.values()))
+
+    rows = [(*subject_key(p), column, value) for p in pet_paths if p in done for column, value in done[p].items()]
+    with ResultsStore(store_path) as store:
+        with stage("run", "store"):
+            store.upsert(FACTOR_TABLE, rows)
+        # Sidecar last, so a failed save never loses the results already in the store
+        deps.save()
+        print(f"✅ Normalization factors updated in: {store_path}")
+        instrumentation.summarize()
+        if excel_file:
+            return store.export_excel(FACTOR_TABLE, excel_file)
+        return store.frame(FACTOR_TABLE)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pons, WM, cerebellum, PS and hn normalizing factors in one pass.")
+    parser.add_argument("directory")
+    parser.add_argument("--factors", nargs="+", choices=FACTORS, default=FACTORS)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--store", default=None, help=f"results store (default: <directory>/{DEFAULT_STORE})")
+    parser.add_argument("--excel", default=None, help="also export normalizing_factors to this workbook")
+    parser.add_argument("--manifest", default=None, help="saved manifest to look files up in instead of walking")
+    parser.add_argument("--force", action="store_true", help="recompute every subject, even if unchanged")
+    parser.add_argument("--profile", default=None, help="write per-subject stage timings to this JSON-lines file")
+    for name, default in REFERENCES.items():
+        parser.add_argument("--" + name.replace("_", "-"), default=default)
+    args = parser.parse_args()
+
+    if args.profile:
+        instrumentation.enable(args.profile)
+
+    references = {name: getattr(args, name) for name in REFERENCES}
+    compute_factors(args.directory, args.factors, references, args.workers, args.store, args.excel,
+                    manifest=args.manifest, incremental=not args.force)
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+import io
+import os
+import matplotlib
+matplotlib.use("Agg")  # headless: figures are only ever written to files
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from concurrent.futures import ProcessPoolExecutor
+
+# One figure per process, cleared and resized for every spec instead of recreated
+_figure = None
+
+
+def _get_figure():
+    global _figure
+    if _figure is None:
+        _figure = Figure()
+        FigureCanvasAgg(_figure)
+    _figure.clear()
+    return _figure
+
+
+def _style(ax):
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+
+
+def _render_hist_qq(fig, spec):
+    """Overlaid percentage histograms of two groups and their QQ plot (average_qqplots.py)."""
+    a, b = np.asarray(spec["a"], dtype=float), np.asarray(spec["b"], dtype=float)
+    label_a, label_b = spec.get("labels", ("DLB", "HC"))
+    color_a, color_b = spec.get("colors", ("#4d65a7", "#e0af0d"))
+    mean_a, mean_b = a.mean(), b.mean()
+    bin_edges = np.histogram_bin_edges(np.concatenate([a, b]), bins=spec.get("bins", 20))
+
+    axes = fig.subplots(1, 2)
+    axes[0].hist(a, bins=bin_edges, alpha=0.6, weights=np.full(len(a), 100 / len(a)),
+                 label=f'{label_a} (mean={mean_a:.2f})', color=color_a)
+    axes[0].hist(b, bins=bin_edges, alpha=0.6, weights=np.full(len(b), 100 / len(b)),
+                 label=f'{label_b} (mean={mean_b:.2f})', color=color_b)
+    axes[0].axvline(mean_a, color=color_a, linestyle='--', linewidth=2)
+    axes[0].axvline(mean_b, color=color_b, linestyle='--', linewidth=2)
+    axes[0].set_xlabel(spec.get("xlabel", ""))
+    axes[0].set_ylabel("Percentage (%)")
+    axes[0].set_title(f"Histogram: {spec['title']}")
+    axes[0].legend()
+
+    quantiles = np.linspace(0, 1, min(len(a), len(b)))
+    q_a, q_b = np.quantile(a, quantiles), np.quantile(b, quantiles)
+    axes[1].scatter(q_b, q_a, alpha=0.7, color="#54037a")
+    vmin, vmax = min(q_a.min(), q_b.min()), max(q_a.max(), q_b.max())
+    axes[1].plot([vmin, vmax], [vmin, vmax], 'k--', lw=2)
+    axes[1].set_xlabel(f"{label_b} quantiles")
+    axes[1].set_ylabel(f"{label_a} quantiles")
+    axes[1].set_title(f"QQ Plot: {spec['title']}")
+
+
+def _render_histogram(fig, spec):
+    """Overlaid histograms of several labelled series with dashed mean lines (plot_rois.py)."""
+    ax = fig.subplots()
+    for label, values in spec["series"]:
+        values = np.asarray(values, dtype=float)
+        mean_value = values.mean()
+        _, _, patches = ax.hist(values, bins=spec.get("bins", 25), alpha=0.5,
+                                label=f"{label} (mean={mean_value:.2f})")
+        ax.axvline(mean_value, linestyle='dashed', linewidth=1.5, color=patches[0].get_facecolor())
+    ax.set_title(spec["title"], fontweight='bold')
+    ax.set_xlabel(spec.get("xlabel", ""))
+    ax.set_ylabel("Frequency")
+    ax.grid(True)
+    ax.legend()
+    _style(ax)
+
+
+def _render_regplot(fig, spec):
+    """Scatter with regression line and 95% CI band (seaborn regplot)."""
+    import seaborn as sns
+    ax = fig.subplots()
+    sns.regplot(x=np.asarray(spec["x"]), y=np.asarray(spec["y"]), ci=95, line_kws={"color": "red"}, ax=ax)
+    ax.set_xlabel(spec.get("xlabel", ""))
+    ax.set_ylabel(spec.get("ylabel", ""))
+    ax.set_title(spec.get("title", ""))
+
+
+def _render_bar_comparison(fig, spec):
+    """Original vs normalized values per region, overlaid bars (r2_aal.py, cv_aal_normfactors.py)."""
+    ax = fig.subplots()
+    labels = list(spec["labels"])
+    x = np.arange(len(labels))
+    ax.bar(x, spec["original"], width=0.65, label="Original", color="#94bedb")
+    ax.bar(x, spec["normalized"], width=0.65, label="Normalized", color="#034296")
+    ax.set_xticks(x)
+    ax.set_xticklabels(labels, rotation=90)
+
+    # Bold only those tick labels that have a normalized value
+    has_norm = np.isfinite(np.asarray(spec["normalized"], dtype=float))
+    for lbl, bold in zip(ax.get_xticklabels(), has_norm):
+        lbl.set_fontweight("bold" if bold else "normal")
+
+    ax.set_xlim(-1, len(labels))
+    ax.set_ylabel(spec.get("ylabel", ""))
+    ax.set_title(spec.get("title", ""))
+    if spec.get("legend", False):
+        ax.legend()
+    _style(ax)
+
+
+def _render_heatmap(fig, spec):
+    """Square heatmap of a labelled matrix (seaborn heatmap)."""
+    import seaborn as sns
+    ax = fig.subplots()
+    matrix = np.asarray(spec["matrix"], dtype=float)
+    labels = list(spec["labels"])
+    annot_kws = {"size": spec["annot_size"]} if "annot_size" in spec else None
+    sns.heatmap(matrix, annot=spec.get("annot", False), fmt=".2f", cmap="coolwarm", square=True, cbar=True,
+                linewidths=0, annot_kws=annot_kws, ax=ax, xticklabels=labels, yticklabels=labels)
+    if "tick_size" in spec:
+        ax.set_xticks(np.arange(len(labels)) + 0.5, labels=labels, rotation=90, fontsize=spec["tick_size"])
+        ax.set_yticks(np.arange(len(labels)) + 0.5, labels=labels, fontsize=spec["tick_size"])
+    ax.set_title(spec.get("title", ""), **spec.get("title_kw", {}))
+
+
+RENDERERS = {
+    "hist_qq": _render_hist_qq,
+    "histogram": _render_histogram,
+    "regplot": _render_regplot,
+    "bar_comparison": _render_bar_comparison,
+    "heatmap": _render_heatmap,
+}
+
+
+def render_spec(spec, dpi=300, to_bytes=False):
+    """Draw one spec on this process's figure; save it to spec["path"] or return PNG bytes."""
+    fig = _get_figure()
+    fig.set_size_inches(*spec.get("figsize", (6, 5)))
+    RENDERERS[spec["kind"]](fig, spec)
+    fig.tight_layout()
+    if to_bytes:
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png", dpi=dpi)
+        return buf.getvalue()
+    os.makedirs(os.path.dirname(spec["path"]) or ".", exist_ok=True)
+    fig.savefig(spec["path"], dpi=dpi)
+    return spec["path"]
+
+
+def _init_worker():
+    matplotlib.use("Agg")
+
+
+def _render_task(args):
+    spec, dpi, to_bytes = args
+    return render_spec(spec, dpi, to_bytes)
+
+
+def render_all(specs, pdf_path=None, n_workers=4, dpi=300):
+    """Render plot specs on a process pool, as individual PNGs or as pages of one PDF.
+
+    Each spec is a dict with a "kind" (see RENDERERS), its data as arrays or
+    lists, an optional "figsize" and, for PNG output, a "path". PDF pages are
+    rasterized at dpi in the workers and assembled in spec order.
+    """
+    specs = list(specs)
+    tasks = [(spec, dpi, pdf_path is not None) for spec in specs]
+    if n_workers > 1 and len(specs) > 1:
+        executor = ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker)
+        results = executor.map(_render_task, tasks)
+    else:
+        executor = None
+        results = map(_render_task, tasks)
+
+    try:
+        if pdf_path is None:
+            outputs = []
+            for path in results:
+                print(f"Saved: {path}")
+                outputs.append(path)
+            return outputs
+
+        from matplotlib.image import imread
+        with PdfPages(pdf_path) as pdf:
+            for png in results:
+                image = imread(io.BytesIO(png), format="png")
+                page = Figure(figsize=(image.shape[1] / dpi, image.shape[0] / dpi))
+                FigureCanvasAgg(page)
+                page.figimage(image)
+                pdf.savefig(page, dpi=dpi)
+        print(f"Saved {len(specs)} pages to {pdf_path}")
+        return [pdf_path]
+    finally:
+        if executor is not None:
+            executor.shutdown()
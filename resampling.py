@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from excel_cache import read_excel
+
+
+def _centered(X, y):
+    """Complete cases of X (n, p) and y (n,), centred on their full-sample means."""
+    X = np.asarray(X, dtype=float)
+    y = np.asarray(y, dtype=float).reshape(-1)
+    valid = np.isfinite(X).all(axis=1) & np.isfinite(y)
+    X, y = X[valid], y[valid]
+    return X - X.mean(axis=0), y - y.mean()
+
+
+def observed_r2(Xc, yc):
+    return (yc @ Xc) ** 2 / ((Xc ** 2).sum(axis=0) * (yc ** 2).sum())
+
+
+def _block_seeds(n_resamples, block_size, seed):
+    """(size, SeedSequence) of every block, so results don't depend on the worker count."""
+    sizes = [min(block_size, n_resamples - start) for start in range(0, n_resamples, block_size)]
+    return list(zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes))))
+
+
+def _permutation_block(Xc, yc, size, seed_seq):
+    """R² of every column against `size` permutations of y, as one (size, n) @ (n, p) product."""
+    rng = np.random.default_rng(seed_seq)
+    perms = rng.permuted(np.tile(np.arange(len(yc)), (size, 1)), axis=1)
+    cross = yc[perms] @ Xc
+    return cross ** 2 / ((Xc ** 2).sum(axis=0) * (yc ** 2).sum())
+
+
+def _bootstrap_block(Xc, yc, size, seed_seq):
+    """R² of every column on `size` bootstrap resamples, given as multinomial count weights."""
+    rng = np.random.default_rng(seed_seq)
+    n = len(yc)
+    W = rng.multinomial(n, np.full(n, 1.0 / n), size=size) / n  # (size, n), rows sum to 1
+    mx = W @ Xc
+    my = W @ yc
+    sxx = W @ (Xc ** 2) - mx ** 2
+    syy = (W @ (yc ** 2) - my ** 2)[:, None]
+    sxy = W @ (Xc * yc[:, None]) - mx * my[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return sxy ** 2 / (sxx * syy)
+
+
+def _run_blocks(func, Xc, yc, n_resamples, block_size, seed, n_workers):
+    blocks = _block_seeds(n_resamples, block_size, seed)
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(func, *zip(*[(Xc, yc, size, s) for size, s in blocks])))
+    else:
+        results = [func(Xc, yc, size, s) for size, s in blocks]
+    return np.vstack(results)
+
+
+def permutation_test(X, y, n_perm=10000, block_size=1000, seed=0, n_workers=1):
+    """Permutation p-value of the R² of every column of X against y (complete cases)."""
+    columns = list(X.columns) if isinstance(X, pd.DataFrame) else list(range(np.shape(X)[1]))
+    Xc, yc = _centered(X, y)
+    r2 = observed_r2(Xc, yc)
+    null = _run_blocks(_permutation_block, Xc, yc, n_perm, block_size, seed, n_workers)
+    exceed = (null >= r2 - 1e-12).sum(axis=0)
+    return pd.DataFrame({"r2": r2, "pvalue_perm": (exceed + 1) / (n_perm + 1), "n": len(yc)},
+                        index=pd.Index(columns, name="predictor"))
+
+
+def bootstrap_r2(X, y, n_boot=10000, block_size=1000, seed=0, n_workers=1, ci=0.95):
+    """Percentile bootstrap CI of every column's R²; also returns the (n_boot, p) resampled R²."""
+    columns = list(X.columns) if isinstance(X, pd.DataFrame) else list(range(np.shape(X)[1]))
+    Xc, yc = _centered(X, y)
+    boot = _run_blocks(_bootstrap_block, Xc, yc, n_boot, block_size, seed, n_workers)
+    alpha = (1 - ci) / 2
+    table = pd.DataFrame({"r2": observed_r2(Xc, yc),
+                          "ci_low": np.nanquantile(boot, alpha, axis=0),
+                          "ci_high": np.nanquantile(boot, 1 - alpha, axis=0)},
+                         index=pd.Index(columns, name="predictor"))
+    return table, pd.DataFrame(boot, columns=columns)
+
+
+def method_differences(X, y, boot, methods, ci=0.95):
+    """R² difference of every pair of methods, with its bootstrap CI and two-sided p-value.
+
+    boot must come from bootstrap_r2 on the same data, so each resample
+    compares both methods on the same subjects.
+    """
+    Xc, yc = _centered(X[methods], y)
+    r2 = dict(zip(methods, observed_r2(Xc, yc)))
+    alpha = (1 - ci) / 2
+    rows = []
+    for a, b in itertools.combinations(methods, 2):
+        diff = (boot[a] - boot[b]).to_numpy()
+        diff = diff[np.isfinite(diff)]
+        p = min(1.0, 2 * min((diff <= 0).mean(), (diff >= 0).mean()))
+        rows.append({"method_a": a, "method_b": b, "r2_diff": r2[a] - r2[b],
+                     "ci_low": np.quantile(diff, alpha), "ci_high": np.quantile(diff, 1 - alpha),
+                     "pvalue_boot": p})
+    return pd.DataFrame(rows)
+
+
+def resample_associations(X, y, methods=(), n_resamples=10000, block_size=1000, seed=0, n_workers=1, ci=0.95):
+    """Permutation p-values and bootstrap CIs of every column's R², plus pairwise method differences."""
+    perm = permutation_test(X, y, n_resamples, block_size, seed, n_workers)
+    boot_table, boot = bootstrap_r2(X, y, n_resamples, block_size, seed + 1, n_workers, ci)
+    summary = perm.join(boot_table[["ci_low", "ci_high"]]).sort_values("r2", ascending=False)
+    differences = method_differences(X, y, boot, list(methods), ci) if len(methods) > 1 else pd.DataFrame()
+    return summary, differences
+
+
+def main(aal, normalizing_factors, output_excel, target="cluster", n_resamples=10000, block_size=1000,
+         seed=0, n_workers=1):
+    # Same tables and cleaning as r2_aal.py
+    df = read_excel(aal).dropna()
+    df = df.drop(df.columns[0], axis=1)
+    df_norm = read_excel(normalizing_factors).dropna()
+    df_norm = df_norm.drop(df_norm.columns[:2], axis=1)
+    if len(df_norm) != len(df):
+        raise ValueError(f"{aal} has {len(df)} complete rows, {normalizing_factors} has {len(df_norm)}")
+
+    predictors = [col for col in df.columns if not col.startswith(("cluster", "age")) and col != target]
+    methods = [col for col in df_norm.columns if col != target]
+    X = df[predictors].reset_index(drop=True)
+    renamed = {m: f"{m} (norm)" if m in X.columns else m for m in methods}
+    X = X.join(df_norm[methods].reset_index(drop=True).rename(columns=renamed))
+    methods = [renamed[m] for m in methods]
+
+    summary, differences = resample_associations(X, df[target].to_numpy(), methods, n_resamples,
+                                                 block_size, seed, n_workers)
+    with pd.ExcelWriter(output_excel) as writer:
+        summary.to_excel(writer, sheet_name="r2")
+        if not differences.empty:
+            differences.to_excel(writer, sheet_name="method_differences", index=False)
+    print(summary)
+    print(f"✅ Done. {n_resamples} permutations / bootstrap resamples saved to {output_excel}")
+    return summary, differences
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Permutation and bootstrap inference of R² against cluster or age.")
+    parser.add_argument("aal")
+    parser.add_argument("normalizing_factors")
+    parser.add_argument("output_excel")
+    parser.add_argument("--target", default="cluster")
+    parser.add_argument("--n", type=int, default=10000, help="permutations and bootstrap resamples")
+    parser.add_argument("--block-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    main(args.aal, args.normalizing_factors, args.output_excel, args.target, args.n, args.block_size,
+         args.seed, args.workers)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import sqlite3
+import numpy as np
+import pandas as pd
+
+DEFAULT_STORE = "results.sqlite"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    tbl     TEXT NOT NULL,
+    grp     TEXT NOT NULL,
+    ipp     TEXT NOT NULL,
+    date    TEXT NOT NULL,
+    col     TEXT NOT NULL,
+    value   REAL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (tbl, grp, ipp, date, col)
+)
+"""
+
+_UPSERT = """
+INSERT INTO results (tbl, grp, ipp, date, col, value, updated) VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (tbl, grp, ipp, date, col) DO UPDATE SET value = excluded.value, updated = excluded.updated
+"""
+
+
+def subject_key(path):
+    """(group, IPP, date) of a file or folder laid out as <group>/<IPP>/<date>/..."""
+    path = os.path.abspath(path)
+    date_dir = path if os.path.isdir(path) else os.path.dirname(path)
+    ipp_dir = os.path.dirname(date_dir)
+    return os.path.basename(os.path.dirname(ipp_dir)), os.path.basename(ipp_dir), os.path.basename(date_dir)
+
+
+class ResultsStore:
+    """Embedded SQLite store of scalar results keyed by (table, group, IPP, date, column).
+
+    Writers upsert single cells inside short transactions, so several
+    extraction jobs can write to the same store concurrently without the
+    read-modify-write of an Excel workbook.
+    """
+
+    def __init__(self, path=DEFAULT_STORE, timeout=60.0):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"PRAGMA busy_timeout={int(timeout * 1000)}")
+        self.conn.execute(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def upsert(self, table, rows):
+        """Atomically insert or replace cells given as (group, ipp, date, column, value)."""
+        now = time.time()
+        records = [(table, str(g), str(i), str(d), str(c), _to_real(v), now) for g, i, d, c, v in rows]
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany(_UPSERT, records)
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return len(records)
+
+    def upsert_row(self, table, group, ipp, date, values):
+        """Upsert every column of one subject's row."""
+        return self.upsert(table, [(group, ipp, date, col, val) for col, val in values.items()])
+
+    def value(self, table, group, ipp, date, col):
+        """One cell, or None; rows imported without a group (group "") match any group."""
+        row = self.conn.execute(
+            "SELECT value FROM results WHERE tbl = ? AND grp IN (?, '') AND ipp = ? AND date = ? AND col = ? "
+            "ORDER BY grp = '' LIMIT 1", (table, str(group), str(ipp), str(date), str(col))).fetchone()
+        return None if row is None else row[0]
+
+    def frame(self, table, group=None, columns=None, with_group=False):
+        """Wide DataFrame of a table: one row per subject, IPP/Date first, columns in insertion order."""
+        query = "SELECT grp, ipp, date, col, value, rowid FROM results WHERE tbl = ?"
+        params = [table]
+        if group is not None:
+            query += " AND grp = ?"
+            params.append(group)
+        long = pd.read_sql_query(query, self.conn, params=params)
+        if columns is not None:
+            long = long[long["col"].isin(columns)]
+
+        col_order = long.groupby("col")["rowid"].min().sort_values().index.tolist() if columns is None else \
+            [c for c in columns if c in set(long["col"])]
+        wide = long.pivot(index=["grp", "ipp", "date"], columns="col", values="value")
+        first_seen = long.groupby(["grp", "ipp", "date"])["rowid"].min()
+        wide = wide.loc[first_seen.sort_values().index, col_order].reset_index()
+        wide = wide.rename(columns={"grp": "Group", "ipp": "IPP", "date": "Date"})
+        wide.columns.name = None
+        if not with_group:
+            wide = wide.drop(columns="Group")
+        return wide
+
+    def export_excel(self, table, output_excel, group=None, with_group=False):
+        """Write a table to Excel (only done on request, never by the producers)."""
+        df = self.frame(table, group=group, with_group=with_group)
+        df.to_excel(output_excel, index=False)
+        print(f"Exported '{table}' ({len(df)} rows) to {output_excel}")
+        return df
+
+    def import_excel(self, table, excel_file, group=""):
+        """Load an existing IPP/Date-keyed workbook (e.g. written by the MATLAB scripts).
+
+        Only numeric columns are imported; blank Group cells fall back to group.
+        """
+        df = pd.read_excel(excel_file, dtype={"IPP": str, "Date": str, "Group": str})
+        groups = df["Group"].fillna(group) if "Group" in df.columns else pd.Series(group, index=df.index)
+        columns = [c for c in df.columns if c not in ("IPP", "Date", "Group")]
+        skipped = [c for c in columns if not pd.api.types.is_numeric_dtype(df[c])]
+        if skipped:
+            print(f"Skipping non-numeric columns of {excel_file}: {', '.join(map(str, skipped))}")
+        columns = [c for c in columns if c not in skipped]
+        rows = []
+        for i, r in df.iterrows():
+            for col in columns:
+                rows.append((groups[i], r["IPP"], r["Date"], col, r[col]))
+        n = self.upsert(table, rows)
+        print(f"Imported {n} values from {excel_file} into '{table}'")
+        return n
+
+
+def _to_real(value):
+    if value is None:
+        return None
+    value = float(value)
+    return None if np.isnan(value) else value
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 5 or sys.argv[1] not in ("export", "import"):
+        print("Usage: python results_store.py export <store.sqlite> <table> <output.xlsx> [group]")
+        print("       python results_store.py import <store.sqlite> <table> <input.xlsx>")
+        sys.exit(1)
+
+    with ResultsStore(sys.argv[2]) as store:
+        if sys.argv[1] == "export":
+            store.export_excel(sys.argv[3], sys.argv[4], group=sys.argv[5] if len(sys.argv) > 5 else None)
+        else:
+            store.import_excel(sys.argv[3], sys.argv[4])
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import math
+import uuid
+import numpy as np
+import pandas as pd
+
+# Relative accuracy of the quantile sketch: every value falls in a log bucket
+# whose representative is within 1% of it
+SKETCH_ALPHA = 0.01
+
+
+class QuantileSketch:
+    """Mergeable log-bucket quantile sketch (DDSketch-like) with a fixed relative accuracy."""
+
+    def __init__(self, alpha=SKETCH_ALPHA, pos=None, neg=None, zero=0):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.pos = pos or {}  # bucket index → count, for values > 0
+        self.neg = neg or {}  # same for -value, values < 0
+        self.zero = zero
+
+    def _bucket(self, x):
+        return int(math.ceil(math.log(x) / self.log_gamma))
+
+    def _value(self, k):
+        return 2 * self.gamma ** k / (self.gamma + 1)
+
+    def add(self, x, count=1):
+        if x > 0:
+            k = self._bucket(x)
+            self.pos[k] = self.pos.get(k, 0) + count
+        elif x < 0:
+            k = self._bucket(-x)
+            self.neg[k] = self.neg.get(k, 0) + count
+        else:
+            self.zero += count
+        # Removal (count=-1) can leave empty buckets behind
+        for store in (self.pos, self.neg):
+            for k in [k for k, c in store.items() if c <= 0]:
+                del store[k]
+
+    def merge(self, other):
+        for mine, theirs in ((self.pos, other.pos), (self.neg, other.neg)):
+            for k, c in theirs.items():
+                mine[k] = mine.get(k, 0) + c
+        self.zero += other.zero
+
+    def buckets(self):
+        """Representative values and counts, in increasing order."""
+        values = [-self._value(k) for k in sorted(self.neg, reverse=True)] + [0.0] * (self.zero > 0) + \
+                 [self._value(k) for k in sorted(self.pos)]
+        counts = [self.neg[k] for k in sorted(self.neg, reverse=True)] + [self.zero] * (self.zero > 0) + \
+                 [self.pos[k] for k in sorted(self.pos)]
+        return np.array(values, dtype=float), np.array(counts, dtype=np.int64)
+
+    def quantiles(self, qs):
+        values, counts = self.buckets()
+        if counts.sum() == 0:
+            return np.full(len(qs), np.nan)
+        cum = np.cumsum(counts)
+        ranks = np.asarray(qs, dtype=float) * (cum[-1] - 1)
+        return values[np.searchsorted(cum, ranks, side="right")]
+
+    def to_json(self):
+        return {"pos": {str(k): c for k, c in self.pos.items()},
+                "neg": {str(k): c for k, c in self.neg.items()}, "zero": self.zero}
+
+    @classmethod
+    def from_json(cls, d, alpha=SKETCH_ALPHA):
+        return cls(alpha, {int(k): c for k, c in d["pos"].items()},
+                   {int(k): c for k, c in d["neg"].items()}, d["zero"])
+
+
+class RegionStats:
+    """Count, sum and sum of squares of one (group, region), plus its quantile sketch."""
+
+    def __init__(self, n=0, total=0.0, sumsq=0.0, sketch=None):
+        self.n = n
+        self.total = total
+        self.sumsq = sumsq
+        self.sketch = sketch or QuantileSketch()
+
+    def add(self, x, sign=1):
+        self.n += sign
+        self.total += sign * x
+        self.sumsq += sign * x * x
+        self.sketch.add(x, sign)
+
+    def merge(self, other):
+        self.n += other.n
+        self.total += other.total
+        self.sumsq += other.sumsq
+        self.sketch.merge(other.sketch)
+
+    def mean(self):
+        return self.total / self.n if self.n > 0 else np.nan
+
+    def std(self):
+        """Sample SD (ddof=1), like pandas."""
+        if self.n < 2:
+            return np.nan
+        return math.sqrt(max(self.sumsq - self.total ** 2 / self.n, 0.0) / (self.n - 1))
+
+    def cv(self):
+        return self.std() / self.mean()
+
+
+class RoiStats:
+    """Per-group, per-region sufficient statistics of ROI rows, updated as rows are produced.
+
+    Rows are added under a subject key so reruns can replace a changed
+    subject's contribution; stores of different shards merge by addition.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.stats = {}    # group → region → RegionStats
+        self.members = {}  # group → set of subject keys
+        if path and os.path.exists(path):
+            with open(path, "r") as f:
+                data = json.load(f)
+            for group, regions in data["stats"].items():
+                self.stats[group] = {r: RegionStats(s["n"], s["sum"], s["sumsq"], QuantileSketch.from_json(s["sketch"]))
+                                     for r, s in regions.items()}
+            self.members = {g: set(keys) for g, keys in data["members"].items()}
+
+    def _apply(self, group, key, row, columns, sign):
+        regions = self.stats.setdefault(group, {})
+        for col in columns:
+            value = row.get(col)
+            if value is None or not np.isfinite(value):
+                continue
+            regions.setdefault(col, RegionStats()).add(float(value), sign)
+
+    def add(self, group, key, row, columns):
+        """Add one subject's ROI values; returns False if the key is already in."""
+        members = self.members.setdefault(group, set())
+        if key in members:
+            return False
+        self._apply(group, key, row, columns, 1)
+        members.add(key)
+        return True
+
+    def remove(self, group, key, row, columns):
+        """Take back a subject's contribution (row must be what was added)."""
+        self._apply(group, key, row, columns, -1)
+        self.members[group].discard(key)
+
+    def sync(self, rows, previous, group_of, columns):
+        """Bring the store in line with the current rows {key: row}.
+
+        previous holds the rows added on earlier runs ({key: row}, e.g. from
+        the .deps.json sidecar); changed and vanished subjects are swapped out
+        with them. If a member has no previous row to subtract, the store is
+        rebuilt from the current rows.
+        """
+        known = {k: g for g, keys in self.members.items() for k in keys}
+        if any(k not in previous for k in known):
+            self.stats, self.members = {}, {}
+            known = {}
+        for key, group in known.items():
+            if key not in rows or previous[key] != rows[key]:
+                self.remove(group, key, previous[key], columns)
+        for key, row in rows.items():
+            self.add(group_of(row), key, row, columns)
+
+    def merge(self, other):
+        for group, regions in other.stats.items():
+            mine = self.stats.setdefault(group, {})
+            for region, s in regions.items():
+                mine.setdefault(region, RegionStats()).merge(s)
+            self.members.setdefault(group, set()).update(other.members.get(group, ()))
+
+    def region(self, group, region):
+        """Statistics of one region, over all groups when group is None."""
+        if group is not None:
+            return self.stats.get(group, {}).get(region, RegionStats())
+        merged = RegionStats()
+        for regions in self.stats.values():
+            if region in regions:
+                merged.merge(regions[region])
+        return merged
+
+    def regions(self, group=None):
+        groups = [group] if group is not None else list(self.stats)
+        names = []
+        for g in groups:
+            names.extend(r for r in self.stats.get(g, {}) if r not in names)
+        return names
+
+    def summary(self, group=None, quantiles=(0.25, 0.5, 0.75)):
+        """n, mean, SD, CV and sketch quantiles of every region."""
+        rows = []
+        for region in self.regions(group):
+            s = self.region(group, region)
+            row = {"region": region, "n": s.n, "mean": s.mean(), "std": s.std(), "cv": s.cv()}
+            row.update({f"q{q:g}": v for q, v in zip(quantiles, s.sketch.quantiles(quantiles))})
+            rows.append(row)
+        return pd.DataFrame(rows).set_index("region") if rows else pd.DataFrame()
+
+    def bootstrap_cv(self, group=None, n_boot=2000, seed=0, ci=0.95):
+        """Bootstrap CI of every region's CV, resampling the sketch buckets with multinomial weights."""
+        rng = np.random.default_rng(seed)
+        alpha = (1 - ci) / 2
+        rows = []
+        for region in self.regions(group):
+            s = self.region(group, region)
+            values, counts = s.sketch.buckets()
+            if s.n < 2:
+                continue
+            W = rng.multinomial(s.n, counts / counts.sum(), size=n_boot)  # (n_boot, buckets)
+            total = W @ values
+            sumsq = W @ values ** 2
+            with np.errstate(divide="ignore", invalid="ignore"):
+                cv = np.sqrt(np.maximum(sumsq - total ** 2 / s.n, 0) / (s.n - 1)) / (total / s.n)
+            rows.append({"region": region, "cv": s.cv(), "ci_low": np.nanquantile(cv, alpha),
+                         "ci_high": np.nanquantile(cv, 1 - alpha)})
+        return pd.DataFrame(rows).set_index("region") if rows else pd.DataFrame()
+
+    def save(self, path=None):
+        path = path or self.path
+        data = {
+            "stats": {g: {r: {"n": s.n, "sum": s.total, "sumsq": s.sumsq, "sketch": s.sketch.to_json()}
+                          for r, s in regions.items()} for g, regions in self.stats.items()},
+            "members": {g: sorted(keys) for g, keys in self.members.items()},
+        }
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+
+def stats_path(output_path):
+    return str(output_path) + ".stats.json"
+
+
+def update_roi_stats(path, rows, previous, group_of, columns):
+    """Sync the store at path with the rows of the latest run and save it."""
+    store = RoiStats(path)
+    store.sync(rows, previous, group_of, columns)
+    store.save(path)
+    print(f"ROI statistics updated: {path}")
+    return store
+
+
+if __name__ == "__main__":
+    # python roi_stats.py summary <stats.json> [group]
+    # python roi_stats.py bootstrap <stats.json> [group]
+    # python roi_stats.py merge <out.json> <shard.json> [<shard.json> ...]
+    if len(sys.argv) < 3 or sys.argv[1] not in ("summary", "bootstrap", "merge"):
+        print("Usage: python roi_stats.py summary|bootstrap <stats.json> [group]")
+        print("       python roi_stats.py merge <out.json> <shard.json> [<shard.json> ...]")
+        sys.exit(1)
+
+    if sys.argv[1] == "merge":
+        merged = RoiStats()
+        for shard in sys.argv[3:]:
+            merged.merge(RoiStats(shard))
+        merged.save(sys.argv[2])
+        print(f"Merged {len(sys.argv) - 3} stores into {sys.argv[2]}")
+    else:
+        store = RoiStats(sys.argv[2])
+        group = sys.argv[3] if len(sys.argv) > 3 else None
+        table = store.summary(group) if sys.argv[1] == "summary" else store.bootstrap_cv(group)
+        print(table.sort_values("cv").to_string())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import os
+import json
+import shutil
+import argparse
+import nibabel as nib
+import numpy as np
+from scipy.spatial import cKDTree
+
+# MNI 2 mm grid of the shoot/ outputs (r_aal.nii, wr_petsuv.nii, wp1/wp2mri.nii)
+MNI_SHAPE = (91, 109, 91)
+MNI_AFFINE = np.array([[-2.0, 0, 0, 90], [0, 2.0, 0, -126], [0, 0, 2.0, -72], [0, 0, 0, 1]])
+
+# Native ~1 mm PET grid of coreg_center_mass_reorient/ and results_assembly/
+NATIVE_SHAPE = (160, 192, 160)
+N_NATIVE_STRUCTURES = 40
+PONS_LABEL = 35
+
+AAL_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), "aal116.json")
+
+
+def _brain(shape, scale=0.42):
+    """Boolean ellipsoid filling most of the grid, and the voxel coordinates normalised to [-1, 1]."""
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing="ij"), axis=-1)
+    return (grid ** 2).sum(axis=-1) < (2 * scale) ** 2, grid
+
+
+def _parcellate(brain, grid, labels, rng):
+    """Label every brain voxel with its nearest of len(labels) random seeds (Voronoi parcels)."""
+    coords = grid[brain]
+    seeds = coords[rng.choice(len(coords), size=len(labels), replace=False)]
+    _, nearest = cKDTree(seeds).query(coords)
+    out = np.zeros(brain.shape, dtype=np.int16)
+    out[brain] = np.asarray(labels, dtype=np.int16)[nearest]
+    return out
+
+
+def _pet(atlas, brain, label_means, rng, noise=0.15):
+    """SUV-like volume: per-label level plus voxel noise inside the brain, 0 outside."""
+    lut = np.zeros(atlas.max() + 1, dtype=np.float32)
+    lut[list(label_means)] = list(label_means.values())
+    pet = lut[atlas] * (1 + noise * rng.standard_normal(atlas.shape, dtype=np.float32))
+    pet[~brain] = 0
+    return pet
+
+
+def _save(data, affine, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    nib.save(nib.Nifti1Image(data, affine), path)
+
+
+def make_cohort(root, n_subjects, groups=("DLB", "HC"), native_shape=NATIVE_SHAPE, seed=0):
+    """Write a synthetic cohort in the folder layout the extraction scripts expect.
+
+    root/
+      aal116.json, r_aal.nii, multreg_cluster.nii     (MNI 2 mm atlas and cluster mask)
+      shoot/<group>/<IPP>/<date>/wr_petsuv.nii, mri/wp1mri.nii, mri/wp2mri.nii
+      coreg_center_mass_reorient/<group>/<IPP>/<date>/pons_r_petsuv.nii.gz   (native ~1 mm)
+      results_assembly/structures.json, native_structures_*.nii.gz, wfu_pons_native_*.nii.gz
+    Subjects are spread round-robin over the groups.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(root, exist_ok=True)
+
+    # MNI atlas with the 116 AAL labels and a cluster mask
+    shutil.copy(AAL_JSON, os.path.join(root, "aal116.json"))
+    with open(AAL_JSON, "r") as f:
+        aal_labels = [int(k) for k in json.load(f)]
+    brain, grid = _brain(MNI_SHAPE)
+    aal = _parcellate(brain, grid, aal_labels, rng)
+    _save(aal, MNI_AFFINE, os.path.join(root, "r_aal.nii"))
+    cluster = (np.isin(aal, aal_labels[:4])).astype(np.uint8)
+    _save(cluster, MNI_AFFINE, os.path.join(root, "multreg_cluster.nii"))
+
+    # Native structures: one label list, a different random parcellation per subject
+    native_labels = list(range(1, N_NATIVE_STRUCTURES + 1))
+    os.makedirs(os.path.join(root, "results_assembly"), exist_ok=True)
+    with open(os.path.join(root, "results_assembly", "structures.json"), "w") as f:
+        json.dump({"structures": [{"label": l, "name": f"Structure_{l}"} for l in native_labels]}, f)
+    native_affine = np.diag([1.0, 1.0, 1.0, 1.0])
+    native_affine[:3, 3] = -np.array(native_shape) / 2
+    native_brain, native_grid = _brain(native_shape)
+
+    subjects = []
+    for i in range(n_subjects):
+        group, ipp, date = groups[i % len(groups)], f"{100000 + i}", f"2020{1 + i % 12:02d}{1 + i % 28:02d}"
+        subjects.append((group, ipp, date))
+        scale = 1 + 0.1 * rng.standard_normal()
+
+        # MNI-space PET and tissue probability maps
+        subject_dir = os.path.join(root, "shoot", group, ipp, date)
+        means = {l: scale * rng.uniform(1.5, 3.5) for l in aal_labels}
+        _save(_pet(aal, brain, means, rng), MNI_AFFINE, os.path.join(subject_dir, "wr_petsuv.nii"))
+        gm = rng.random(MNI_SHAPE, dtype=np.float32) * brain
+        _save(gm, MNI_AFFINE, os.path.join(subject_dir, "mri", "wp1mri.nii"))
+        _save((1 - gm) * brain, MNI_AFFINE, os.path.join(subject_dir, "mri", "wp2mri.nii"))
+
+        # Native PET, structures atlas and pons mask
+        structures = _parcellate(native_brain, native_grid, native_labels, rng)
+        means = {l: scale * rng.uniform(1.5, 3.5) for l in native_labels}
+        _save(_pet(structures, native_brain, means, rng), native_affine,
+              os.path.join(root, "coreg_center_mass_reorient", group, ipp, date, "pons_r_petsuv.nii.gz"))
+        _save(structures, native_affine,
+              os.path.join(root, "results_assembly", f"native_structures_{group}_{ipp}_{date}.nii.gz"))
+        _save((structures == PONS_LABEL).astype(np.uint8), native_affine,
+              os.path.join(root, "results_assembly", f"wfu_pons_native_{group}_{ipp}_{date}.nii.gz"))
+
+    print(f"Synthetic cohort of {n_subjects} subjects written to {root}")
+    return subjects
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic PET cohort for benchmarking.")
+    parser.add_argument("root")
+    parser.add_argument("n_subjects", type=int)
+    parser.add_argument("--native-shape", type=int, nargs=3, default=list(NATIVE_SHAPE))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    make_cohort(args.root, args.n_subjects, native_shape=tuple(args.native_shape), seed=args.seed)
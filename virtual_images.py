@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+import os
+import re
+import argparse
+import nibabel as nib
+import numpy as np
+from volume_cache import load_nifti, nifti_stem
+from results_store import ResultsStore, DEFAULT_STORE, subject_key
+
+FACTOR_TABLE = "normalizing_factors"
+
+# <method>_<source>, e.g. hn_wr_petsuv, pons_wr_petsuv, ihn001_wr_petsuv, ips001_wr_petsuv
+# → factor column hn, pons, ihn_001, ips_001
+_NAME = re.compile(r"^(?:(pons|wm|cerebellum|ps|hn)|(ihn|ips)(\d+))_(.+)$")
+
+
+def parse_name(name):
+    """(factor column, source name) of a normalized image name, or None if it isn't one."""
+    match = _NAME.match(nifti_stem(name))
+    if match is None:
+        return None
+    method, thresholded, threshold, source = match.groups()
+    return (method if method else f"{thresholded}_{threshold}"), source
+
+
+class _DividedProxy:
+    """Array proxy that divides the source proxy by a factor on every read."""
+
+    def __init__(self, source, factor):
+        self.source = source
+        self.factor = factor
+        self.shape = source.shape
+        self.ndim = len(source.shape)
+        self.dtype = np.dtype(np.float64)
+
+    def __getitem__(self, slices):
+        return np.asarray(self.source[slices], dtype=np.float64) / self.factor
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+
+class VirtualImage:
+    """A normalized image (source / factor) that is never written unless materialized.
+
+    Quacks like the nibabel images the extraction scripts use: shape,
+    affine, header, dataobj (sliceable) and get_fdata().
+    """
+
+    def __init__(self, path, source_path, factor):
+        self.path = path
+        self.source_path = source_path
+        self.factor = float(factor)
+        self.source = load_nifti(source_path)
+        self.shape = self.source.shape
+        self.affine = self.source.affine
+        self.header = self.source.header
+        self.dataobj = _DividedProxy(self.source.dataobj, self.factor)
+
+    def get_fdata(self, dtype=np.float64):
+        return np.asarray(self.dataobj[...], dtype=dtype)
+
+    def materialize(self, path=None):
+        """Write the normalized volume as a real NIfTI (float32), e.g. for SPM; returns its path."""
+        path = path or self.path
+        header = self.header.copy()
+        header.set_data_dtype(np.float32)
+        nib.save(nib.Nifti1Image(self.get_fdata(np.float32), self.affine, header), path)
+        print(f"Materialized {path} = {self.source_path} / {self.factor:.4f}")
+        return path
+
+
+def resolve(path, store_path=DEFAULT_STORE, table=FACTOR_TABLE):
+    """VirtualImage of a normalized image path, from its source in the same folder and its stored factor."""
+    parsed = parse_name(path)
+    if parsed is None:
+        raise ValueError(f"{path} is not a normalized image name")
+    column, source = parsed
+    folder = os.path.dirname(path)
+    ext = os.path.basename(path)[len(nifti_stem(path)):] or ".nii"
+    source_path = next((p for p in (os.path.join(folder, source + e) for e in (ext, ".nii", ".nii.gz"))
+                        if os.path.exists(p)), None)
+    if source_path is None:
+        raise FileNotFoundError(f"No source image {source} for {path}")
+
+    with ResultsStore(store_path) as store:
+        factor = store.value(table, *subject_key(path), column)
+    if factor is None or not np.isfinite(factor) or factor == 0:
+        raise KeyError(f"No '{column}' factor for {path} in {store_path}")
+    return VirtualImage(path, source_path, factor)
+
+
+def open_image(path, store_path=DEFAULT_STORE, table=FACTOR_TABLE):
+    """The real image when it exists on disk, otherwise its virtual normalized view."""
+    if os.path.exists(path):
+        return load_nifti(path)
+    return resolve(path, store_path, table)
+
+
+def virtual_paths(name, directory):
+    """Paths of <name>.nii next to every source image under directory (the files need not exist)."""
+    parsed = parse_name(name)
+    if parsed is None:
+        return []
+    source = parsed[1]
+    paths = []
+    for dirpath, _, filenames in os.walk(directory):
+        for ext in (".nii", ".nii.gz"):
+            if source + ext in filenames:
+                paths.append(os.path.join(dirpath, nifti_stem(name) + ext))
+    return sorted(paths)
+
+
+def materialize_all(name, directory, store_path=DEFAULT_STORE, overwrite=False):
+    """Write <name> for every subject under directory that has a source image and a factor."""
+    written = []
+    for path in virtual_paths(name, directory):
+        if os.path.exists(path) and not overwrite:
+            continue
+        try:
+            written.append(resolve(path, store_path).materialize())
+        except (KeyError, FileNotFoundError) as e:
+            print(f"Skipping {path}: {e}")
+    print(f"✅ {len(written)} images written")
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Normalized PET images as views of wr_petsuv / factor.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_show = sub.add_parser("show", help="print the source and factor of a normalized image path")
+    p_show.add_argument("path")
+    p_mat = sub.add_parser("materialize", help="write real files, e.g. for SPM")
+    p_mat.add_argument("name", help="e.g. hn_wr_petsuv, ihn001_wr_petsuv or ips001_wr_petsuv")
+    p_mat.add_argument("directory")
+    p_mat.add_argument("--overwrite", action="store_true")
+    for p in (p_show, p_mat):
+        p.add_argument("--store", default=DEFAULT_STORE, help="results store holding normalizing_factors")
+    args = parser.parse_args()
+
+    if args.command == "show":
+        img = resolve(args.path, args.store)
+        print(f"{img.path} = {img.source_path} / {img.factor:.6f}  shape {img.shape}")
+    else:
+        materialize_all(args.name, args.directory, args.store, args.overwrite)
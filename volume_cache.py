@@ -0,0 +1,103 @@
+import os
+import uuid
+import nibabel as nib
+import numpy as np
+from atlas_cache import memo_file_hash
+
+# Decompressed volumes are stored once per content hash, evicted least-recently-used first
+CACHE_DIR = os.environ.get("NII_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "nii_volumes"))
+MAX_BYTES = int(os.environ.get("NII_CACHE_MAX_BYTES", 20 * 1024 ** 3))
+
+
+def _atomic_write(path, data):
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def nifti_stem(path):
+    """File name without its .nii / .nii.gz extension."""
+    name = os.path.basename(path)
+    return name[:-7] if name.endswith(".nii.gz") else os.path.splitext(name)[0]
+
+
+def _content_key(path, cache_dir):
+    """Content hash of a file, memoised per (path, size, mtime) so unchanged files are hashed once."""
+    return memo_file_hash(path, os.path.join(cache_dir, "index"))
+
+
+def evict(cache_dir=None, max_bytes=None, keep=None):
+    """Delete least-recently-used volumes (except keep) until the cache fits in max_bytes."""
+    cache_dir = cache_dir or CACHE_DIR
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    data_dir = os.path.join(cache_dir, "data")
+
+    entries = []
+    for entry in os.scandir(data_dir):
+        if entry.name.endswith(".npy"):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, npy_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if npy_path == keep:
+            continue
+        for p in (npy_path, npy_path[:-4] + ".hdr"):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def load_nifti(path, cache_dir=None, max_bytes=None):
+    """nib.load replacement that serves .nii.gz volumes from the decompressed cache.
+
+    The data is stored once as an uncompressed .npy in its on-disk dtype (or
+    float when the header has a scaling) and memory-mapped copy-on-write.
+    Other files are passed straight to nib.load.
+    """
+    path = str(path)
+    if not path.endswith(".gz"):
+        return nib.load(path)
+
+    cache_dir = cache_dir or CACHE_DIR
+    os.makedirs(os.path.join(cache_dir, "index"), exist_ok=True)
+    os.makedirs(os.path.join(cache_dir, "data"), exist_ok=True)
+
+    key = _content_key(path, cache_dir)
+    npy_path = os.path.join(cache_dir, "data", key + ".npy")
+    hdr_path = os.path.join(cache_dir, "data", key + ".hdr")
+
+    if os.path.exists(npy_path) and os.path.exists(hdr_path):
+        os.utime(npy_path)  # mark as recently used
+    else:
+        img = nib.load(path)
+        data = np.asanyarray(img.dataobj)
+        _atomic_write(hdr_path, img.header.binaryblock)
+        tmp = f"{npy_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, data)
+        os.replace(tmp, npy_path)
+        evict(cache_dir, max_bytes, keep=npy_path)
+
+    with open(hdr_path, "rb") as f:
+        block = f.read()
+    header_class = nib.Nifti2Header if len(block) == nib.Nifti2Header.template_dtype.itemsize else nib.Nifti1Header
+    image_class = nib.Nifti2Image if header_class is nib.Nifti2Header else nib.Nifti1Image
+    header = header_class(binaryblock=block)
+    data = np.load(npy_path, mmap_mode="c")
+    return image_class(data, header.get_best_affine(), header)
+
+
+def read_slab(img, slices, dtype=np.float32):
+    """Scaled values of a sub-block of an image, without reading the rest.
+
+    Slicing the array proxy only reads the bytes of the slab for uncompressed
+    files; images from load_nifti(.nii.gz) are sliced through the memory map
+    of the decompressed cache.
+    """
+    return np.asarray(img.dataobj[slices], dtype=dtype)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import os
+import argparse
+import nibabel as nib
+import numpy as np
+from scipy import stats
+from atlas_cache import load_atlas_index, flat_view
+from volume_cache import load_nifti
+from results_store import ResultsStore, DEFAULT_STORE, subject_key
+from hist_mode_factors import threshold_suffix
+
+# Input image of each method, as used by masks_ihn.m / masks_ips.m
+METHOD_INPUTS = {"ihn": "s_hn_wr_petsuv.nii", "ips": "s_ps_wr_petsuv.nii"}
+
+
+def find_scans(directory, name):
+    scans = []
+    for dirpath, _, filenames in os.walk(directory):
+        if name in filenames:
+            scans.append(os.path.join(dirpath, name))
+    return sorted(scans)
+
+
+def spm_global(volume):
+    """Global mean as in spm_global: mean of the voxels above 1/8 of the whole-image mean."""
+    finite = volume[np.isfinite(volume)]
+    return finite[finite > finite.mean() / 8].mean()
+
+
+def scaled_values(path, voxels):
+    """Mask voxel values after proportional scaling of the global mean to 50."""
+    volume = load_nifti(path).get_fdata()
+    return flat_view(volume)[voxels] * (50.0 / spm_global(volume))
+
+
+def control_statistics(control_files, voxels):
+    """Per-voxel mean, SD and count of the control group, computed once."""
+    values = np.stack([scaled_values(f, voxels) for f in control_files])
+    valid = np.isfinite(values).all(axis=0)
+    return values.mean(axis=0), values.std(axis=0, ddof=1), len(control_files), valid
+
+
+def single_subject_pvalues(patients, ctrl_mean, ctrl_sd, n_controls):
+    """F-test p-values (1, n-1 df) of each patient row against the control group.
+
+    A deliberate approximation of the masks_ihn.m design, not validated
+    against an SPM run: SPM is set to unequal variance (des.t2.variance = 1)
+    and estimates non-sphericity by ReML pooled over voxels, whereas here
+    each voxel uses the classical single-case test with the error variance
+    of the controls alone, t = (x - mean) / (sd * sqrt(1 + 1/n)), F = t².
+    Voxels with zero control SD give NaN.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = (patients - ctrl_mean) / (ctrl_sd * np.sqrt(1 + 1 / n_controls))
+    return stats.f.sf(t ** 2, 1, n_controls - 1)
+
+
+def subject_masks(patient_dir, control_dir, threshold=0.01, method="ihn", mask_path="parenchymal_mask.nii",
+                  block_size=32, store_path=None, excel_file=None):
+    """Write <method>_mask<thr>.nii for every patient and record the removed-voxel counts."""
+    input_name = METHOD_INPUTS[method]
+    threshold_str = threshold_suffix(threshold)
+    column = f"{method}_{threshold_str}"
+
+    mask_index = load_atlas_index(mask_path, threshold=0)
+    voxels = mask_index.mask_voxels()
+    mask_img = nib.load(mask_path)
+
+    control_files = find_scans(control_dir, input_name)
+    patient_files = find_scans(patient_dir, input_name)
+    ctrl_mean, ctrl_sd, n_controls, ctrl_valid = control_statistics(control_files, voxels)
+    print(f"Control statistics from {n_controls} scans over {len(voxels)} mask voxels")
+    # No test is possible where the controls don't vary; those voxels are left out of every mask
+    testable = ctrl_valid & (ctrl_sd > 0)
+    if (ctrl_valid & ~testable).any():
+        print(f"{int((ctrl_valid & ~testable).sum())} mask voxels with zero control SD excluded")
+
+    rows = []
+    for start in range(0, len(patient_files), block_size):
+        block = patient_files[start:start + block_size]
+        patients = np.stack([scaled_values(f, voxels) for f in block])
+        pvals = single_subject_pvalues(patients, ctrl_mean, ctrl_sd, n_controls)
+
+        # Analysis mask (SPM mask.nii): explicit mask, finite data in every scan and a testable voxel
+        analysis = testable & np.isfinite(patients)
+        kept = analysis & ~(pvals < threshold)
+
+        for pet_file, analysis_row, kept_row in zip(block, analysis, kept):
+            out = np.zeros(mask_index.shape, dtype=np.uint8, order="F")
+            flat_view(out)[voxels[kept_row]] = 1
+            header = mask_img.header.copy()
+            header.set_data_dtype(np.uint8)
+            out_path = os.path.join(os.path.dirname(pet_file), f"{method}_mask{threshold_str}.nii")
+            nib.save(nib.Nifti1Image(out, mask_img.affine, header), out_path)
+
+            vox_removed = int(analysis_row.sum() - kept_row.sum())
+            rows.append((*subject_key(pet_file), column, vox_removed))
+            print(f"⚙️ {out_path}: {vox_removed} voxels removed")
+
+    store_path = store_path or os.path.join(os.path.dirname(patient_dir.rstrip("/")), DEFAULT_STORE)
+    with ResultsStore(store_path) as store:
+        store.upsert("masks_voxel", rows)
+        print(f"✅ Masks voxel table updated: {store_path}")
+        if excel_file:
+            store.export_excel("masks_voxel", excel_file)
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Single-subject vs controls masks (masks_ihn.m / masks_ips.m).")
+    parser.add_argument("patient_dir")
+    parser.add_argument("control_dir")
+    parser.add_argument("threshold", nargs="?", type=float, default=0.01)
+    parser.add_argument("--method", choices=sorted(METHOD_INPUTS), default="ihn")
+    parser.add_argument("--mask", default="parenchymal_mask.nii")
+    parser.add_argument("--block-size", type=int, default=32)
+    parser.add_argument("--store", default=None, help=f"results store (default: next to patient_dir, {DEFAULT_STORE})")
+    parser.add_argument("--excel", default=None, help="also export masks_voxel to this workbook")
+    args = parser.parse_args()
+
+    subject_masks(args.patient_dir, args.control_dir, args.threshold, args.method, args.mask,
+                  args.block_size, args.store, args.excel)